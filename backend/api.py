@@ -1,26 +1,151 @@
-from fastapi import FastAPI, HTTPException, File, UploadFile, Form
+from fastapi import FastAPI, HTTPException, File, UploadFile, Form, BackgroundTasks
 from pydantic import BaseModel, Field
-from requests import request
-from sql_agent import SQLAgent
-from visualization_agent import VisualizationAgent
-from typing import Optional, Dict
+from fastapi.concurrency import run_in_threadpool
+from typing import Optional, Dict, List
 from fastapi.middleware.cors import CORSMiddleware  # Add this import
+from fastapi.responses import PlainTextResponse, StreamingResponse
 import sqlite3
 import json
-from langchain_openai import ChatOpenAI
 import logging
-import pandas as pd
 import os
-import requests
-import tempfile
 import time
 import io
+import zipfile
+import asyncio
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
+import metrics
+from metrics import STAGE_DURATION
+from singleflight import SingleFlight, normalize_question
+from llm_limiter import LLM_LIMITER, llm_priority
+from engine_manager import ENGINES
+from export import (ResultHandles, EXPORT_FORMATS, export_statement, fingerprint, encode_cursor, decode_cursor,
+                    stream_export, fetch_page)
 
-logging.basicConfig(level=logging.INFO)
+# Set TALKQL_LOG_LEVEL=DEBUG to log the full message lists of every agent node
+logging.basicConfig(level=os.getenv("TALKQL_LOG_LEVEL", "INFO").upper())
 logger = logging.getLogger(__name__)
-app = FastAPI()
-sql_agent = SQLAgent()
-viz_agent = VisualizationAgent()
+
+# The agents pull in langchain, langgraph, pandas and matplotlib, so they are
+# only imported and constructed on first use (or by the background warmup)
+_sql_agent = None
+_viz_agent = None
+_llm = None
+_agents_lock = threading.Lock()
+
+def get_sql_agent():
+    global _sql_agent
+    if _sql_agent is None:
+        with _agents_lock:
+            if _sql_agent is None:
+                from sql_agent import SQLAgent
+                _sql_agent = SQLAgent()
+    return _sql_agent
+
+def get_viz_agent():
+    global _viz_agent
+    if _viz_agent is None:
+        with _agents_lock:
+            if _viz_agent is None:
+                from visualization_agent import VisualizationAgent
+                _viz_agent = VisualizationAgent()
+    return _viz_agent
+
+def get_llm():
+    global _llm
+    if _llm is None:
+        with _agents_lock:
+            if _llm is None:
+                from langchain_openai import ChatOpenAI
+                _llm = ChatOpenAI(model="gpt-4o-mini", temperature=0, max_retries=0,
+                                  callbacks=[metrics.llm_callback_handler()])
+    return _llm
+
+# Identical questions arriving while one is still being answered share its response
+query_flights = SingleFlight("query")
+# Lets clients export a result they were shown without sending its SQL back
+result_handles = ResultHandles()
+
+# Uploaded CSVs are checked on their first rows before they are stored
+CSV_VALIDATION_ROWS = 1000
+
+# Tracks the background warmup so /check-connection can report readiness
+warmup_state = {"status": "idle", "error": None}
+# Serializes connecting, restoring and disconnecting, so a /query arriving while the startup
+# warmup restores the stored connection waits for it instead of restoring it a second time
+connection_lock = threading.Lock()
+# Set on shutdown; the warmup thread can't be cancelled, so it checks this between steps
+shutting_down = threading.Event()
+# How long shutdown waits for a running warmup before closing the database connections
+WARMUP_SHUTDOWN_TIMEOUT = 10
+
+def restore_connection():
+    """Re-create the SQL agent connection from the persisted connection store"""
+    with connection_lock:
+        if get_sql_agent().db_uri:
+            # Restored by another thread while this one waited
+            return True
+        return _restore_connection()
+
+def connect_database(db_type: str, connection_params: dict):
+    with connection_lock:
+        get_sql_agent().add_db(db_type=db_type, **connection_params)
+
+def disconnect():
+    with connection_lock:
+        if _sql_agent is not None:
+            _sql_agent.reset()
+
+def _restore_connection():
+    conn = sqlite3.connect('db_store.sqlite')
+    cursor = conn.cursor()
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS connections (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            db_type TEXT NOT NULL,
+            connection_params TEXT NOT NULL,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+    cursor.execute('SELECT db_type, connection_params FROM connections ORDER BY id DESC LIMIT 1')
+    result = cursor.fetchone()
+    conn.close()
+
+    if not result:
+        return False
+    db_type, connection_params = result
+    get_sql_agent().add_db(db_type=db_type, **json.loads(connection_params))
+    return True
+
+def warm_up():
+    """Restore the stored connection and prebuild every cache needed to answer a query"""
+    warmup_state.update(status="warming", error=None)
+    start = time.perf_counter()
+    try:
+        get_viz_agent().warmup()
+        if shutting_down.is_set():
+            return
+        if (get_sql_agent().db_uri or restore_connection()) and not shutting_down.is_set():
+            get_sql_agent().warmup()
+        warmup_state["status"] = "ready"
+        logger.info(f"Warmup finished in {time.perf_counter() - start:.2f}s")
+    except Exception as e:
+        warmup_state.update(status="failed", error=str(e))
+        logger.error(f"Warmup failed: {str(e)}")
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Warm up in the background so the server starts accepting requests immediately
+    warmup_task = asyncio.create_task(asyncio.to_thread(warm_up))
+    yield
+    # Cancelling the task would not stop its thread: ask it to stop and give it time to finish
+    shutting_down.set()
+    await asyncio.wait([warmup_task], timeout=WARMUP_SHUTDOWN_TIMEOUT)
+    # Close pooled database connections on shutdown
+    ENGINES.dispose_all()
+
+app = FastAPI(lifespan=lifespan)
 
 app.add_middleware(
     CORSMiddleware,
@@ -29,8 +154,6 @@ app.add_middleware(
     allow_methods=["*"],
     allow_headers=["*"],
 )
-llm = ChatOpenAI(model="gpt-4o-mini", temperature=0)
-
 class DatabaseConnection(BaseModel):
     db_type: str
     connection_params: Dict[str, str]
@@ -39,11 +162,53 @@ class Query(BaseModel):
     query: str
     vizEnabled: bool = Field(default=True, description="Whether visualization should be generated")
     tabularMode: bool = Field(default=False, description="Whether to display results in tabular format")
+    thread_id: Optional[str] = Field(default=None, description="Conversation thread; follow-up questions on the same thread reuse the previous schema, SQL and results")
+    approximate: bool = Field(default=False, description="Answer from a sample of the table when the generated SQL allows it")
+    sample_percent: float = Field(default=1.0, gt=0, lt=100, description="Percentage of rows to sample in approximate mode")
 
 class QueryResponse(BaseModel):
     query_result: str
     query_used: str
+    sampled_query: Optional[str] = Field(default=None, description="The SQL that actually ran when the answer is approximate; query_used stays exact")
+    viz_result: Optional[str] = None
+    thread_id: Optional[str] = None
+    result_handle: Optional[str] = Field(default=None, description="Pass to /query/export or /query/page to get the full result")
+
+class BatchQuery(BaseModel):
+    queries: List[str] = Field(..., min_length=1, max_length=100, description="Questions to answer against the connected database")
+    vizEnabled: bool = Field(default=False, description="Whether visualizations should be generated for each question")
+    tabularMode: bool = Field(default=False, description="Whether to display results in tabular format")
+    max_concurrency: int = Field(default=8, ge=1, le=32, description="Maximum number of questions processed in parallel")
+
+class BatchItemResult(BaseModel):
+    query: str
+    query_result: Optional[str] = None
+    query_used: Optional[str] = None
+    sampled_query: Optional[str] = None
     viz_result: Optional[str] = None
+    result_handle: Optional[str] = None
+    error: Optional[str] = None
+
+class BatchQueryResponse(BaseModel):
+    results: List[BatchItemResult]
+
+class ExportRequest(BaseModel):
+    query_used: Optional[str] = Field(default=None, description="SQL from a previous response")
+    result_handle: Optional[str] = Field(default=None, description="Handle from a previous response, instead of query_used")
+    format: str = Field(default="csv", description="csv, ndjson or parquet")
+    full_result: bool = Field(default=True, description="Drop the row limit the answer was generated with")
+
+class PageRequest(BaseModel):
+    query_used: Optional[str] = Field(default=None, description="SQL from a previous response")
+    result_handle: Optional[str] = Field(default=None, description="Handle from a previous response, instead of query_used")
+    cursor: Optional[str] = Field(default=None, description="next_cursor of the previous page; omit for the first page")
+    page_size: int = Field(default=1000, ge=1, le=10000)
+    full_result: bool = Field(default=True, description="Drop the row limit the answer was generated with")
+
+class PageResponse(BaseModel):
+    columns: List[str]
+    rows: List[list]
+    next_cursor: Optional[str] = None
 
 class isSingularResponse(BaseModel):
     is_singular: bool = Field(
@@ -81,12 +246,18 @@ async def check_connection():
             return {
                 "is_connected": True,
                 "db_type": db_type,
-                "database_name": database_name
+                "database_name": database_name,
+                "is_ready": _sql_agent is not None and _sql_agent.is_ready,
+                "warmup_status": warmup_state["status"]
             }
-        return {"is_connected": False}
+        return {"is_connected": False, "is_ready": False, "warmup_status": warmup_state["status"]}
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
+@app.get("/metrics", response_class=PlainTextResponse)
+async def get_metrics():
+    return PlainTextResponse(metrics.render(), media_type="text/plain; version=0.0.4")
+
 @app.post("/disconnect-database")
 async def disconnect_database():
     try:
@@ -95,12 +266,15 @@ async def disconnect_database():
         cursor.execute('DELETE FROM connections')
         conn.commit()
         conn.close()
+        await run_in_threadpool(disconnect)
+        warmup_state.update(status="idle", error=None)
         return {"message": "Successfully disconnected"}
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
 @app.post("/add-database")
 async def add_database(
+    background_tasks: BackgroundTasks,
     file: Optional[UploadFile] = None,
     connection: str = Form(...)
 ):
@@ -116,14 +290,23 @@ async def add_database(
                 file_path = f"uploads/{file.filename}"
                 content = await file.read()
                 
-                # Validate CSV content
-                try:
-                    pd.read_csv(io.BytesIO(content))
-                except Exception as e:
-                    raise HTTPException(
-                        status_code=400,
-                        detail=f"Invalid CSV file: {str(e)}"
-                    )
+                if file.filename.lower().endswith(".zip"):
+                    # An archive of CSV/Parquet files, loaded as one table per file
+                    if not zipfile.is_zipfile(io.BytesIO(content)):
+                        raise HTTPException(status_code=400, detail="Invalid zip archive")
+                elif file.filename.lower().endswith(".parquet"):
+                    if not content.startswith(b"PAR1"):
+                        raise HTTPException(status_code=400, detail="Invalid Parquet file")
+                else:
+                    # Validate CSV content; the loader parses the rest, and only what changed on re-uploads
+                    import pandas as pd
+                    try:
+                        pd.read_csv(io.BytesIO(content), nrows=CSV_VALIDATION_ROWS)
+                    except Exception as e:
+                        raise HTTPException(
+                            status_code=400,
+                            detail=f"Invalid CSV file: {str(e)}"
+                        )
                 
                 with open(file_path, "wb") as f:
                     f.write(content)
@@ -159,82 +342,178 @@ async def add_database(
         conn.commit()
         conn.close()
 
-        # Connect using sql_agent
-        sql_agent.add_db(
-            db_type=db_type,
-            **connection_params
-        )
+        # Connect using sql_agent, off the event loop since loading a CSV or waiting for a restore can take a while
+        await run_in_threadpool(connect_database, db_type, connection_params)
+        # Open the connection and build the caches before the first question arrives
+        warmup_state.update(status="warming", error=None)
+        background_tasks.add_task(warm_up)
         
-        return {"message": "Database connected successfully"}
+        response = {"message": "Database connected successfully"}
+        if get_sql_agent().ingestion_report:
+            response["ingestion"] = get_sql_agent().ingestion_report
+        if get_sql_agent().refresh_report:
+            response["refresh"] = get_sql_agent().refresh_report
+        return response
     except Exception as e:
         logger.error(f"Error connecting to database: {str(e)}")
         raise HTTPException(status_code=500, detail=str(e))
     
+def ensure_connection():
+    """Return the SQL agent, reconnecting from the connection store if the connection was lost"""
+    sql_agent = get_sql_agent()
+    if not sql_agent.db_uri and not restore_connection():
+        raise HTTPException(
+            status_code=400,
+            detail="No database connection established"
+        )
+    return sql_agent
+
+def run_query(query: Query) -> QueryResponse:
+    """Run the full SQL + visualization pipeline for one question"""
+    sql_agent = ensure_connection()
+
+    viz_result = None
+    # Log before the operation
+    logger.info(f"Received query: {query.query}")
+    logger.info(f"Visualization enabled: {query.vizEnabled}")
+    
+    # Modify query if tabular mode is enabled
+    processed_query = f"{query.query} Provide result in tabular format" if query.tabularMode else query.query
+    logger.info(f"Processed query with tabular mode {query.tabularMode}: {processed_query}")
+    
+    # Execute query with modified or original query
+    with STAGE_DURATION.time(stage="sql"):
+        query_result, query_used, sampled_query = sql_agent.graph_workflow(
+            processed_query, thread_id=query.thread_id,
+            sample_percent=query.sample_percent if query.approximate else None)
+    
+    logger.info(f"Query executed. Result: {query_result[:100]}...")
+    
+    # Only check for singularity if visualization is enabled
+    if query.vizEnabled:
+        try:
+            with STAGE_DURATION.time(stage="singularity_check"):
+                is_singular = LLM_LIMITER.invoke(get_llm().with_structured_output(isSingularResponse), query_result)
+            logger.info(f"Singularity check: {is_singular}")
+            
+            # Only generate visualization if vizEnabled is True and result is not singular
+            if not is_singular.is_singular:
+                logger.info("Query result is not singular, generating visualization...")
+                with STAGE_DURATION.time(stage="visualization"):
+                    viz_result = get_viz_agent().graph_workflow(query_result)
+                logger.info(f"Visualization generated: {viz_result[:100] if viz_result else 'None'}...")
+            else:
+                logger.info("Query result is singular, skipping visualization")
+        except Exception as e:
+            logger.error(f"Error in singularity check: {str(e)}")
+    else:
+        logger.info("Visualization disabled, skipping visualization generation")
+    
+    # Return response with or without visualization
+    return QueryResponse(
+        query_result=query_result,
+        query_used=query_used,
+        sampled_query=sampled_query,
+        viz_result=viz_result if viz_result and viz_result.startswith('data:image') else None,
+        thread_id=query.thread_id,
+        result_handle=result_handles.add(sql_agent.connection_key, query_used) if query_used else None
+    )
+
+def run_batch(batch: BatchQuery) -> BatchQueryResponse:
+    """Answer every question of a batch with bounded parallelism, keeping the input order"""
+    sql_agent = ensure_connection()
+    # Open the connection, reflect the schema and compile the graph once for the whole batch
+    sql_agent.warmup()
+
+    def answer(question: str) -> BatchItemResult:
+        try:
+            # Batch work yields to interactive /query traffic at the LLM limiter
+            with llm_priority("batch"):
+                response = run_query(Query(query=question, vizEnabled=batch.vizEnabled, tabularMode=batch.tabularMode))
+            return BatchItemResult(query=question, **response.model_dump(exclude={"thread_id"}))
+        except Exception as e:
+            detail = e.detail if isinstance(e, HTTPException) else str(e)
+            logger.error(f"Error processing batch question {question!r}: {detail}")
+            return BatchItemResult(query=question, error=detail)
+
+    with STAGE_DURATION.time(stage="batch"):
+        with ThreadPoolExecutor(max_workers=min(batch.max_concurrency, len(batch.queries))) as executor:
+            results = list(executor.map(answer, batch.queries))
+    return BatchQueryResponse(results=results)
+
 @app.post("/query", response_model=QueryResponse)
 async def execute_query(query: Query):
     try:
-        # Check if database connection is lost and reconnect if necessary
-        if not sql_agent.db:
-            conn = sqlite3.connect('db_store.sqlite')
-            cursor = conn.cursor()
-            cursor.execute('SELECT db_type, connection_params FROM connections LIMIT 1')
-            result = cursor.fetchone()
-            conn.close()
-            
-            if result:
-                db_type, connection_params = result
-                params = json.loads(connection_params)
-                sql_agent.add_db(db_type=db_type, **params)
-                sql_agent.get_db()
-            else:
-                raise HTTPException(
-                    status_code=400,
-                    detail="No database connection established"
-                )
-            
-        viz_result = None
-        # Log before the operation
-        logger.info(f"Received query: {query.query}")
-        logger.info(f"Visualization enabled: {query.vizEnabled}")
-        
-        # Modify query if tabular mode is enabled
-        processed_query = f"{query.query} Provide result in tabular format" if query.tabularMode else query.query
-        logger.info(f"Processed query with tabular mode {query.tabularMode}: {processed_query}")
-        
-        # Execute query with modified or original query
-        query_result, query_used = sql_agent.graph_workflow(processed_query)
-        
-        logger.info(f"Query executed. Result: {query_result[:100]}...")
-        
-        # Only check for singularity if visualization is enabled
-        if query.vizEnabled:
-            try:
-                is_singular = llm.with_structured_output(isSingularResponse).invoke(query_result)
-                logger.info(f"Singularity check: {is_singular}")
-                
-                # Only generate visualization if vizEnabled is True and result is not singular
-                if not is_singular.is_singular:
-                    logger.info("Query result is not singular, generating visualization...")
-                    viz_result = viz_agent.graph_workflow(query_result)
-                    logger.info(f"Visualization generated: {viz_result[:100] if viz_result else 'None'}...")
-                else:
-                    logger.info("Query result is singular, skipping visualization")
-            except Exception as e:
-                logger.error(f"Error in singularity check: {str(e)}")
-        else:
-            logger.info("Visualization disabled, skipping visualization generation")
-        
-        # Return response with or without visualization
-        return QueryResponse(
-            query_result=query_result,
-            query_used=query_used,
-            viz_result=viz_result if viz_result and viz_result.startswith('data:image') else None
-        )
-        
+        # The pipeline blocks on LLM and database calls, so keep it off the event loop
+        if query.thread_id:
+            # Conversation turns depend on the thread's history and are never shared
+            return await run_in_threadpool(run_query, query)
+        key = (get_sql_agent().connection_key, normalize_question(query.query), query.vizEnabled, query.tabularMode,
+               query.approximate and query.sample_percent)
+        return await query_flights.do(key, run_in_threadpool, run_query, query)
+    except HTTPException:
+        raise
     except Exception as e:
         logger.error(f"Error processing query: {str(e)}")
         raise HTTPException(status_code=500, detail=str(e))
-    
+
+@app.post("/query/batch", response_model=BatchQueryResponse)
+async def execute_batch_query(batch: BatchQuery):
+    try:
+        return await run_in_threadpool(run_batch, batch)
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.error(f"Error processing batch: {str(e)}")
+        raise HTTPException(status_code=500, detail=str(e))
+
+def resolve_export(query_used: Optional[str], result_handle: Optional[str], full_result: bool):
+    """(engine, statement) for an export request, validated before anything is executed"""
+    sql_agent = ensure_connection()
+    if result_handle:
+        query_used = result_handles.get(sql_agent.connection_key, result_handle)
+        if query_used is None:
+            raise HTTPException(status_code=404, detail="Unknown or expired result handle; send query_used instead")
+    if not query_used:
+        raise HTTPException(status_code=400, detail="Either query_used or result_handle is required")
+    try:
+        statement = export_statement(query_used, full_result)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    return ENGINES.get(sql_agent.db_uri), statement, sql_agent.connection_key
+
+@app.post("/query/export")
+async def export_query(request: ExportRequest):
+    """Stream the full result of a query as CSV, NDJSON or Parquet, without involving the LLM"""
+    from sqlalchemy.exc import SQLAlchemyError
+
+    engine, statement, _ = resolve_export(request.query_used, request.result_handle, request.full_result)
+    try:
+        chunks = await run_in_threadpool(stream_export, engine, statement, request.format)
+    except (ValueError, SQLAlchemyError) as e:
+        logger.error(f"Error exporting query: {str(e)}")
+        raise HTTPException(status_code=400, detail=str(e))
+    logger.info(f"Exporting {request.format}: {statement[:100]}")
+    return StreamingResponse(
+        chunks, media_type=EXPORT_FORMATS[request.format],
+        headers={"Content-Disposition": f'attachment; filename="talkql_export.{request.format}"'})
+
+@app.post("/query/page", response_model=PageResponse)
+async def page_query(request: PageRequest):
+    """One page of the full result of a query, with a cursor for the next page"""
+    from sqlalchemy.exc import SQLAlchemyError
+
+    engine, statement, connection_key = resolve_export(request.query_used, request.result_handle, request.full_result)
+    query_fingerprint = fingerprint(connection_key, statement)
+    try:
+        offset = decode_cursor(request.cursor, query_fingerprint) if request.cursor else 0
+        columns, rows, more = await run_in_threadpool(fetch_page, engine, statement, offset, request.page_size)
+    except (ValueError, SQLAlchemyError) as e:
+        logger.error(f"Error paging query: {str(e)}")
+        raise HTTPException(status_code=400, detail=str(e))
+    next_cursor = encode_cursor(query_fingerprint, offset + len(rows)) if more else None
+    return PageResponse(columns=columns, rows=rows, next_cursor=next_cursor)
+
 if __name__ == "__main__":
     import uvicorn
     uvicorn.run(app, host="0.0.0.0", port=8000)
\ No newline at end of file
@@ -0,0 +1,190 @@
+"""
+Deterministic stand-in for ChatOpenAI used by the offline benchmarks.
+
+The agents only talk to the model through pydantic tools bound with a forced
+tool_choice (`with_structured_output` or the SQL agent's shared tool list) and
+parse the tool call. FakeChatModel answers the chosen tool with a canned payload,
+sleeps for a configurable latency and reports token usage so the instrumentation
+records the same metrics as a real model.
+
+PrefixCache simulates provider-side prompt caching: the part of a prompt that
+repeats the beginning of an earlier one is reported as cached tokens and costs
+a fraction of the latency of fresh tokens. As with OpenAI, tool definitions
+come before the messages, so they are part of the prefix.
+"""
+import hashlib
+import json
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Callable, Dict, List, Optional
+
+from langchain_core.language_models.chat_models import BaseChatModel
+from langchain_core.messages import AIMessage, BaseMessage
+from langchain_core.outputs import ChatGeneration, ChatResult
+from langchain_core.utils.function_calling import convert_to_openai_tool
+
+DEFAULT_SQL = "SELECT name FROM sqlite_master WHERE type = 'table' LIMIT 10"
+
+DEFAULT_CHART_CODE = """
+import matplotlib.pyplot as plt
+categories = ['Rock', 'Jazz', 'Metal', 'Latin', 'Blues']
+values = [835, 130, 264, 391, 81]
+plt.figure(figsize=(8, 5))
+plt.bar(categories, values, color='#6366F1', alpha=0.8)
+plt.title('Tracks per genre')
+"""
+
+
+def estimate_tokens(text: str) -> int:
+    """Rough OpenAI token estimate: four characters per token"""
+    return max(1, len(text) // 4)
+
+
+def first_question(messages: List[BaseMessage]) -> str:
+    for message in messages:
+        if message.type == "human":
+            return message.content
+    return ""
+
+
+def last_ai_content(messages: List[BaseMessage]) -> str:
+    for message in reversed(messages):
+        if message.type == "ai":
+            return str(message.content)
+    return ""
+
+
+def prompt_text(messages: List[BaseMessage], tools: Optional[List[dict]] = None) -> str:
+    """The prompt in the order a provider reads it: tool definitions first, then the messages"""
+    return ("".join(f"<tool>{json.dumps(tool, sort_keys=True)}\n" for tool in tools or [])
+            + "".join(f"<{message.type}>{message.content}\n" for message in messages))
+
+
+def chosen_tool(tools: List[dict], tool_choice=None) -> str:
+    """Name of the tool a call must answer with: the forced tool_choice, else the first tool"""
+    if isinstance(tool_choice, dict):
+        return tool_choice["function"]["name"]
+    if isinstance(tool_choice, str) and tool_choice not in ("auto", "none", "required", "any"):
+        return tool_choice
+    return tools[0]["function"]["name"]
+
+
+class PrefixCache:
+    """
+    Provider-style prompt prefix cache. Prompts are hashed in blocks of block_tokens,
+    each block chained to the ones before it, so a block hits only if the whole prefix
+    up to it was seen before. Like OpenAI, prompts shorter than min_tokens are not cached.
+    """
+
+    def __init__(self, block_tokens: int = 128, min_tokens: int = 1024, max_blocks: int = 100_000):
+        self.block_tokens = block_tokens
+        self.min_tokens = min_tokens
+        self.max_blocks = max_blocks
+        self._blocks = OrderedDict()
+        self._lock = threading.Lock()
+
+    def lookup(self, text: str) -> int:
+        """Number of leading tokens of text served from cache; the prompt is cached for later calls"""
+        if estimate_tokens(text) < self.min_tokens:
+            return 0
+        block_chars = self.block_tokens * 4
+        digest, cached, hit = b"", 0, True
+        with self._lock:
+            for start in range(0, len(text) - block_chars + 1, block_chars):
+                digest = hashlib.sha1(digest + text[start:start + block_chars].encode()).digest()
+                if hit and digest in self._blocks:
+                    cached += self.block_tokens
+                    self._blocks.move_to_end(digest)
+                    continue
+                hit = False
+                self._blocks[digest] = None
+                if len(self._blocks) > self.max_blocks:
+                    self._blocks.popitem(last=False)
+        return cached
+
+
+def default_responses(sql_by_question: Dict[str, str]) -> Dict[str, Callable[[List[BaseMessage]], dict]]:
+    """Canned answers for every structured output schema used by the backend"""
+    def sql(messages):
+        question = first_question(messages)
+        for key, query in sql_by_question.items():
+            if key.lower() in question.lower():
+                return {"query": query}
+        return {"query": DEFAULT_SQL}
+
+    return {
+        "DBQuery": sql,
+        "OptimizedQuery": sql,
+        "SubmitFinalAnswer": lambda messages: {"final_answer": f"Result:\n{last_ai_content(messages)[:2000]}"},
+        "isSingularResponse": lambda messages: {"is_singular": False},
+        "VisualizationAdvice": lambda messages: {"advice": "Use a vertical bar chart with data labels on every bar."},
+        "VisualizationCode": lambda messages: {"code": DEFAULT_CHART_CODE},
+    }
+
+
+class FakeChatModel(BaseChatModel):
+    """Chat model returning canned tool calls after a simulated latency"""
+
+    latency: float = 0.0
+    latency_per_1k_prompt_tokens: float = 0.0
+    # Share of the per-token latency charged for cached prompt tokens
+    cached_latency_fraction: float = 0.1
+    prefix_cache: Optional[PrefixCache] = None
+    sql_by_question: Dict[str, str] = {}
+    responses: Dict[str, Any] = {}
+    model_name: str = "fake-llm"
+
+    @property
+    def _llm_type(self) -> str:
+        return "fake-chat-model"
+
+    @property
+    def _identifying_params(self) -> Dict[str, Any]:
+        return {"model_name": self.model_name}
+
+    def bind_tools(self, tools, *, tool_choice=None, **kwargs):
+        return self.bind(tools=[convert_to_openai_tool(tool) for tool in tools], tool_choice=tool_choice, **kwargs)
+
+    def _respond(self, tool_name: str, messages: List[BaseMessage]) -> dict:
+        responder = self.responses.get(tool_name) or default_responses(self.sql_by_question).get(tool_name)
+        if responder is None:
+            raise ValueError(f"FakeChatModel has no canned response for {tool_name}")
+        return responder(messages)
+
+    def _generate(
+        self,
+        messages: List[BaseMessage],
+        stop: Optional[List[str]] = None,
+        run_manager=None,
+        **kwargs: Any,
+    ) -> ChatResult:
+        tools = kwargs.get("tools") or []
+        text = prompt_text(messages, tools)
+        prompt_tokens = estimate_tokens(text)
+        cached_tokens = min(prompt_tokens, self.prefix_cache.lookup(text)) if self.prefix_cache else 0
+        billed_tokens = prompt_tokens - cached_tokens + self.cached_latency_fraction * cached_tokens
+        time.sleep(self.latency + self.latency_per_1k_prompt_tokens * billed_tokens / 1000)
+
+        if tools:
+            name = chosen_tool(tools, kwargs.get("tool_choice"))
+            args = self._respond(name, messages)
+            content = ""
+            tool_calls = [{"name": name, "args": args, "id": f"call_{name}", "type": "tool_call"}]
+            completion_tokens = estimate_tokens(json.dumps(args))
+        else:
+            content = f"Echo: {messages[-1].content}"[:200]
+            tool_calls = []
+            completion_tokens = estimate_tokens(content)
+
+        message = AIMessage(
+            content=content,
+            tool_calls=tool_calls,
+            usage_metadata={
+                "input_tokens": prompt_tokens,
+                "output_tokens": completion_tokens,
+                "total_tokens": prompt_tokens + completion_tokens,
+                "input_token_details": {"cache_read": cached_tokens},
+            },
+        )
+        return ChatResult(generations=[ChatGeneration(message=message)], llm_output={"model_name": self.model_name})
@@ -0,0 +1,142 @@
+"""
+Local stand-in for the OpenAI chat completions API.
+
+Unlike FakeChatModel, which replaces the client, this server sits behind a real
+ChatOpenAI client so the HTTP path, error mapping and retries are exercised. It
+enforces a requests-per-second quota with 429 responses (and Retry-After), and
+its latency rises once more requests are in flight than its capacity, like an
+overloaded provider.
+
+    server = FakeOpenAIServer(requests_per_second=20, capacity=8).start()
+    llm = ChatOpenAI(model="gpt-4o-mini", base_url=server.base_url, api_key="offline", max_retries=0)
+"""
+import json
+import threading
+import time
+from collections import deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from langchain_core.messages import convert_to_messages
+
+from fake_llm import PrefixCache, chosen_tool, default_responses, estimate_tokens, prompt_text
+
+
+class FakeOpenAIServer:
+    def __init__(self, latency=0.05, requests_per_second=None, capacity=None, retry_after=0.5,
+                 sql_by_question=None, prefix_cache=None, port=0):
+        """
+        Args:
+            latency: base response time in seconds
+            requests_per_second: quota over a sliding one second window; None disables 429s
+            capacity: concurrent requests served at base latency; each extra one adds
+                `latency / capacity` to every response
+            retry_after: value of the Retry-After header on 429 responses
+            prefix_cache: PrefixCache reporting cached prompt tokens; a private one by default
+        """
+        self.latency = latency
+        self.requests_per_second = requests_per_second
+        self.capacity = capacity
+        self.retry_after = retry_after
+        self.responses = default_responses(sql_by_question or {})
+        self.prefix_cache = prefix_cache or PrefixCache()
+        self.stats = {"requests": 0, "rate_limited": 0, "max_in_flight": 0}
+        self._recent = deque()
+        self._in_flight = 0
+        self._lock = threading.Lock()
+        self._server = ThreadingHTTPServer(("127.0.0.1", port), self._handler())
+        self._server.daemon_threads = True
+
+    @property
+    def base_url(self):
+        host, port = self._server.server_address[:2]
+        return f"http://{host}:{port}/v1"
+
+    def start(self):
+        threading.Thread(target=self._server.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def _admit(self):
+        """Return the latency to simulate, or None if the request is over quota"""
+        now = time.monotonic()
+        with self._lock:
+            self.stats["requests"] += 1
+            if self.requests_per_second is not None:
+                while self._recent and now - self._recent[0] > 1.0:
+                    self._recent.popleft()
+                if len(self._recent) >= self.requests_per_second:
+                    self.stats["rate_limited"] += 1
+                    return None
+                self._recent.append(now)
+            self._in_flight += 1
+            self.stats["max_in_flight"] = max(self.stats["max_in_flight"], self._in_flight)
+            overload = max(0, self._in_flight - self.capacity) if self.capacity else 0
+            return self.latency * (1 + overload / self.capacity) if self.capacity else self.latency
+
+    def _done(self):
+        with self._lock:
+            self._in_flight -= 1
+
+    def complete(self, body):
+        messages = convert_to_messages(
+            [{"role": m["role"], "content": m.get("content") or ""} for m in body["messages"]])
+        tools = body.get("tools") or []
+        text = prompt_text(messages, tools)
+        prompt_tokens = estimate_tokens(text)
+        cached_tokens = min(prompt_tokens, self.prefix_cache.lookup(text))
+        if tools:
+            name = chosen_tool(tools, body.get("tool_choice"))
+            arguments = json.dumps(self.responses[name](messages))
+            message = {"role": "assistant", "content": None, "tool_calls": [
+                {"id": f"call_{name}", "type": "function", "function": {"name": name, "arguments": arguments}}]}
+            finish_reason, completion_tokens = "tool_calls", estimate_tokens(arguments)
+        else:
+            content = f"Echo: {messages[-1].content}"[:200]
+            message = {"role": "assistant", "content": content}
+            finish_reason, completion_tokens = "stop", estimate_tokens(content)
+        return {
+            "id": "chatcmpl-fake",
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": body.get("model", "fake"),
+            "choices": [{"index": 0, "message": message, "finish_reason": finish_reason}],
+            "usage": {"prompt_tokens": prompt_tokens, "completion_tokens": completion_tokens,
+                      "total_tokens": prompt_tokens + completion_tokens,
+                      "prompt_tokens_details": {"cached_tokens": cached_tokens}},
+        }
+
+    def _handler(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                body = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))))
+                latency = server._admit()
+                if latency is None:
+                    self._send(429, {"error": {"message": "Rate limit reached", "type": "requests",
+                                               "code": "rate_limit_exceeded"}},
+                               {"Retry-After": str(server.retry_after)})
+                    return
+                try:
+                    time.sleep(latency)
+                    self._send(200, server.complete(body))
+                finally:
+                    server._done()
+
+            def _send(self, status, payload, headers=None):
+                data = json.dumps(payload).encode()
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(data)))
+                for key, value in (headers or {}).items():
+                    self.send_header(key, value)
+                self.end_headers()
+                self.wfile.write(data)
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
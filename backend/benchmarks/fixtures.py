@@ -0,0 +1,164 @@
+"""
+Local database fixtures for the offline benchmarks.
+
+- build_chinook: a Chinook-style music store (artists, albums, tracks, genres,
+  customers, invoices, invoice lines) generated deterministically
+- build_wide_schema: many wide tables to stress schema reflection and prompt size
+- build_large_csv: a large CSV export to stress CSV ingestion
+- build_csv_directory: the Chinook tables exported as one CSV per table, optionally zipped
+"""
+import csv
+import os
+import random
+import sqlite3
+import zipfile
+from datetime import date, timedelta
+
+GENRES = ["Rock", "Jazz", "Metal", "Alternative & Punk", "Blues", "Latin", "Reggae", "Pop", "Classical", "Soundtrack"]
+COUNTRIES = ["USA", "Canada", "Brazil", "France", "Germany", "United Kingdom", "India", "Portugal", "Chile", "Norway"]
+
+CHINOOK_SCHEMA = """
+CREATE TABLE Artist (ArtistId INTEGER PRIMARY KEY, Name NVARCHAR(120));
+CREATE TABLE Album (AlbumId INTEGER PRIMARY KEY, Title NVARCHAR(160) NOT NULL,
+    ArtistId INTEGER NOT NULL REFERENCES Artist (ArtistId));
+CREATE TABLE Genre (GenreId INTEGER PRIMARY KEY, Name NVARCHAR(120));
+CREATE TABLE Track (TrackId INTEGER PRIMARY KEY, Name NVARCHAR(200) NOT NULL,
+    AlbumId INTEGER REFERENCES Album (AlbumId), GenreId INTEGER REFERENCES Genre (GenreId),
+    Milliseconds INTEGER NOT NULL, UnitPrice NUMERIC(10,2) NOT NULL);
+CREATE TABLE Customer (CustomerId INTEGER PRIMARY KEY, FirstName NVARCHAR(40) NOT NULL,
+    LastName NVARCHAR(20) NOT NULL, Country NVARCHAR(40), Email NVARCHAR(60) NOT NULL);
+CREATE TABLE Invoice (InvoiceId INTEGER PRIMARY KEY, CustomerId INTEGER NOT NULL REFERENCES Customer (CustomerId),
+    InvoiceDate DATETIME NOT NULL, BillingCountry NVARCHAR(40), Total NUMERIC(10,2) NOT NULL);
+CREATE TABLE InvoiceLine (InvoiceLineId INTEGER PRIMARY KEY, InvoiceId INTEGER NOT NULL REFERENCES Invoice (InvoiceId),
+    TrackId INTEGER NOT NULL REFERENCES Track (TrackId), UnitPrice NUMERIC(10,2) NOT NULL, Quantity INTEGER NOT NULL);
+"""
+
+# Questions the benchmarks ask, with the SQL the fake model "generates" for them
+CHINOOK_QUESTIONS = {
+    "tracks per genre": (
+        "SELECT g.Name, COUNT(t.TrackId) AS Tracks FROM Genre g "
+        "JOIN Track t ON t.GenreId = g.GenreId GROUP BY g.Name ORDER BY Tracks DESC LIMIT 10"
+    ),
+    "sales by country": (
+        "SELECT BillingCountry, ROUND(SUM(Total), 2) AS Sales FROM Invoice "
+        "GROUP BY BillingCountry ORDER BY Sales DESC LIMIT 10"
+    ),
+    "top artists by revenue": (
+        "SELECT ar.Name, ROUND(SUM(il.UnitPrice * il.Quantity), 2) AS Revenue FROM InvoiceLine il "
+        "JOIN Track t ON t.TrackId = il.TrackId JOIN Album al ON al.AlbumId = t.AlbumId "
+        "JOIN Artist ar ON ar.ArtistId = al.ArtistId GROUP BY ar.Name ORDER BY Revenue DESC LIMIT 10"
+    ),
+    "yearly sales": (
+        "SELECT strftime('%Y', InvoiceDate) AS Year, ROUND(SUM(Total), 2) AS Sales FROM Invoice "
+        "GROUP BY Year ORDER BY Year LIMIT 10"
+    ),
+}
+
+
+def build_chinook(path: str, scale: int = 1, seed: int = 7) -> str:
+    """Create a Chinook-style SQLite database; `scale` multiplies the row counts"""
+    if os.path.exists(path):
+        os.remove(path)
+    rng = random.Random(seed)
+    conn = sqlite3.connect(path)
+    conn.executescript(CHINOOK_SCHEMA)
+
+    artists = 275 * scale
+    albums = 347 * scale
+    tracks = 3503 * scale
+    customers = 59 * scale
+    invoices = 412 * scale
+
+    conn.executemany("INSERT INTO Genre VALUES (?, ?)", list(enumerate(GENRES, start=1)))
+    conn.executemany("INSERT INTO Artist VALUES (?, ?)", [(i, f"Artist {i}") for i in range(1, artists + 1)])
+    conn.executemany(
+        "INSERT INTO Album VALUES (?, ?, ?)",
+        [(i, f"Album {i}", rng.randint(1, artists)) for i in range(1, albums + 1)])
+    conn.executemany(
+        "INSERT INTO Track VALUES (?, ?, ?, ?, ?, ?)",
+        [(i, f"Track {i}", rng.randint(1, albums), rng.randint(1, len(GENRES)),
+          rng.randint(60_000, 600_000), rng.choice([0.99, 1.99])) for i in range(1, tracks + 1)])
+    conn.executemany(
+        "INSERT INTO Customer VALUES (?, ?, ?, ?, ?)",
+        [(i, f"First{i}", f"Last{i}", rng.choice(COUNTRIES), f"customer{i}@example.com")
+         for i in range(1, customers + 1)])
+
+    start = date(2009, 1, 1)
+    invoice_rows, line_rows = [], []
+    line_id = 1
+    for invoice_id in range(1, invoices + 1):
+        customer = rng.randint(1, customers)
+        total = 0.0
+        for _ in range(rng.randint(1, 14)):
+            price = rng.choice([0.99, 1.99])
+            line_rows.append((line_id, invoice_id, rng.randint(1, tracks), price, 1))
+            total += price
+            line_id += 1
+        invoice_date = start + timedelta(days=rng.randint(0, 5 * 365))
+        invoice_rows.append((invoice_id, customer, invoice_date.isoformat(), rng.choice(COUNTRIES), round(total, 2)))
+    conn.executemany("INSERT INTO Invoice VALUES (?, ?, ?, ?, ?)", invoice_rows)
+    conn.executemany("INSERT INTO InvoiceLine VALUES (?, ?, ?, ?, ?)", line_rows)
+    conn.commit()
+    conn.close()
+    return path
+
+
+def build_wide_schema(path: str, tables: int = 120, columns: int = 60, rows: int = 50, seed: int = 7) -> str:
+    """Create a SQLite database with many wide tables to stress schema handling"""
+    if os.path.exists(path):
+        os.remove(path)
+    rng = random.Random(seed)
+    conn = sqlite3.connect(path)
+    for t in range(tables):
+        column_defs = ", ".join(
+            f"metric_{c} REAL" if c % 3 else f"attribute_{c} TEXT" for c in range(columns))
+        conn.execute(f"CREATE TABLE wide_table_{t} (id INTEGER PRIMARY KEY, {column_defs})")
+        placeholders = ", ".join("?" for _ in range(columns + 1))
+        conn.executemany(
+            f"INSERT INTO wide_table_{t} VALUES ({placeholders})",
+            [[r] + [rng.random() * 1000 if c % 3 else f"value_{rng.randint(0, 20)}" for c in range(columns)]
+             for r in range(rows)])
+    conn.commit()
+    conn.close()
+    return path
+
+
+def build_large_csv(path: str, rows: int = 500_000, seed: int = 7) -> str:
+    """Write a large orders CSV export"""
+    rng = random.Random(seed)
+    start = date(2020, 1, 1)
+    with open(path, "w", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow(["order_id", "order_date", "customer_id", "country", "product", "quantity", "amount"])
+        for i in range(1, rows + 1):
+            writer.writerow([
+                i,
+                (start + timedelta(days=rng.randint(0, 1500))).isoformat(),
+                rng.randint(1, 50_000),
+                rng.choice(COUNTRIES),
+                f"product_{rng.randint(1, 500)}",
+                rng.randint(1, 10),
+                round(rng.random() * 500, 2),
+            ])
+    return path
+
+
+def build_csv_directory(path: str, scale: int = 1, archive: bool = False) -> str:
+    """Export the Chinook tables as one CSV file per table, without any key declarations"""
+    os.makedirs(path, exist_ok=True)
+    conn = sqlite3.connect(build_chinook(os.path.join(path, "chinook.db"), scale))
+    tables = [row[0] for row in conn.execute("SELECT name FROM sqlite_master WHERE type = 'table'")]
+    for table in tables:
+        cursor = conn.execute(f"SELECT * FROM {table}")
+        with open(os.path.join(path, f"{table}.csv"), "w", newline="") as f:
+            writer = csv.writer(f)
+            writer.writerow([column[0] for column in cursor.description])
+            writer.writerows(cursor)
+    conn.close()
+    os.remove(os.path.join(path, "chinook.db"))
+    if not archive:
+        return path
+    with zipfile.ZipFile(f"{path}.zip", "w", zipfile.ZIP_DEFLATED) as zf:
+        for table in tables:
+            zf.write(os.path.join(path, f"{table}.csv"), f"chinook/{table}.csv")
+    return f"{path}.zip"
@@ -0,0 +1,98 @@
+"""
+Cold-start guard for the API module.
+
+Runs `python -X importtime -c "import api"` in a fresh interpreter, reports the
+slowest top-level imports and fails when the import exceeds the budget or when
+one of the heavy modules that should only load on first use is pulled in.
+
+Usage (from the backend directory):
+    python benchmarks/import_time.py --budget-ms 1000 --runs 5
+"""
+import argparse
+import os
+import re
+import subprocess
+import sys
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Modules that must stay out of `import api`; they load on first use or in the warmup
+HEAVY_MODULES = [
+    "pandas",
+    "numpy",
+    "matplotlib",
+    "langchain_experimental",
+    "langchain_openai",
+    "langchain_community",
+    "langgraph",
+    "sql_agent",
+    "visualization_agent",
+]
+
+LINE_PATTERN = re.compile(r"^import time:\s+(\d+)\s+\|\s+(\d+)\s+\|(\s*)(\S+)")
+
+
+def measure_import(module: str):
+    """Import `module` in a fresh interpreter and return its -X importtime entries"""
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        cwd=BACKEND_DIR,
+        capture_output=True,
+        text=True,
+    )
+    if result.returncode != 0:
+        raise RuntimeError(f"Importing {module} failed:\n{result.stderr}")
+
+    entries = []
+    for line in result.stderr.splitlines():
+        match = LINE_PATTERN.match(line)
+        if match:
+            self_us, cumulative_us, indent, name = match.groups()
+            # Nested imports are indented by two spaces per level
+            depth = (len(indent) - 1) // 2
+            entries.append((name, int(self_us), int(cumulative_us), depth))
+    return entries
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Guard the cold-start import budget of the API")
+    parser.add_argument("--module", default="api")
+    parser.add_argument("--budget-ms", type=float, default=float(os.getenv("TALKQL_IMPORT_BUDGET_MS", 1000)))
+    parser.add_argument("--runs", type=int, default=5, help="The fastest run is compared to the budget")
+    parser.add_argument("--top", type=int, default=10)
+    args = parser.parse_args()
+
+    runs = [measure_import(args.module) for _ in range(args.runs)]
+    # Interpreter startup (site, encodings) is reported separately and not counted
+    totals = [sum(cumulative for name, _, cumulative, depth in entries if depth == 0 and name == args.module) for entries in runs]
+    best = min(range(len(runs)), key=lambda i: totals[i])
+    entries = runs[best]
+    total_ms = totals[best] / 1000
+
+    print(f"import {args.module}: best {total_ms:.1f} ms, worst {max(totals) / 1000:.1f} ms over {args.runs} runs")
+    print(f"Slowest imports made by {args.module}:")
+    # -X importtime lists children before their parent, so the direct imports of
+    # the module are the depth-1 entries preceding it
+    end = max(i for i, e in enumerate(entries) if e[0] == args.module and e[3] == 0)
+    start = max((i for i, e in enumerate(entries[:end]) if e[3] == 0), default=-1) + 1
+    top_level = sorted((e for e in entries[start:end] if e[3] == 1), key=lambda e: e[2], reverse=True)
+    for name, _, cumulative, _ in top_level[:args.top]:
+        print(f"  {cumulative / 1000:8.1f} ms  {name}")
+
+    failures = []
+    imported = {name for name, _, _, _ in entries}
+    leaked = [m for m in HEAVY_MODULES if m in imported]
+    if leaked:
+        failures.append(f"heavy modules imported eagerly: {', '.join(leaked)}")
+    if total_ms > args.budget_ms:
+        failures.append(f"import took {total_ms:.1f} ms, budget is {args.budget_ms:.1f} ms")
+
+    for failure in failures:
+        print(f"FAIL: {failure}")
+    if failures:
+        sys.exit(1)
+    print("OK: within the cold-start budget")
+
+
+if __name__ == "__main__":
+    main()
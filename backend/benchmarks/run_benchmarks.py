@@ -0,0 +1,505 @@
+"""
+Offline end-to-end benchmarks for TalkQL.
+
+Every scenario runs against local fixtures with FakeChatModel standing in for
+OpenAI, so results are reproducible and need no network or API key. Per-stage
+timings come from the same metrics registry that backs /metrics.
+
+Usage (from the backend directory):
+    python benchmarks/run_benchmarks.py
+    python benchmarks/run_benchmarks.py --scenarios api --concurrency 1,8,32 --latency 0.2
+    python benchmarks/run_benchmarks.py --scenarios llm_limiter --concurrency 32 --llm-rps 20
+    python benchmarks/run_benchmarks.py --json bench.json
+"""
+import argparse
+import asyncio
+import json
+import logging
+import os
+import resource
+import statistics
+import sys
+import tempfile
+import time
+import tracemalloc
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, BACKEND_DIR)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+os.environ.setdefault("OPENAI_API_KEY", "offline-benchmark")
+os.environ.setdefault("TALKQL_LOG_LEVEL", "WARNING")
+# FakeChatModel has no quota; the llm_limiter scenario sets its own limits
+os.environ.setdefault("TALKQL_LLM_RPM", "1000000")
+os.environ.setdefault("TALKQL_LLM_TPM", "1000000000")
+
+import metrics  # noqa: E402
+from metrics import NODE_DURATION, STAGE_DURATION, LLM_TOKENS, DB_QUERY_DURATION  # noqa: E402
+from fake_llm import FakeChatModel, PrefixCache  # noqa: E402
+from fixtures import (CHINOOK_QUESTIONS, build_chinook, build_wide_schema, build_large_csv,  # noqa: E402
+                      build_csv_directory)
+
+SCENARIOS = ["sql_agent", "sql_agent_wide", "csv_ingest", "viz_agent", "api", "api_batch", "llm_limiter", "multi_file_ingest"]
+
+
+def fake_llm(args, **kwargs):
+    return FakeChatModel(
+        latency=args.latency,
+        latency_per_1k_prompt_tokens=args.latency_per_1k_tokens,
+        prefix_cache=PrefixCache(),
+        callbacks=[metrics.llm_callback_handler()],
+        **kwargs,
+    )
+
+
+def percentile(values, pct):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, int(round(pct / 100 * (len(ordered) - 1))))
+    return ordered[index]
+
+
+def summarize(latencies):
+    return {
+        "runs": len(latencies),
+        "mean_s": statistics.mean(latencies) if latencies else 0.0,
+        "p50_s": percentile(latencies, 50),
+        "p95_s": percentile(latencies, 95),
+    }
+
+
+def node_breakdown(agent, nodes):
+    """Mean wall time per graph node recorded since the last registry reset"""
+    breakdown = {}
+    for node in nodes:
+        count, total = NODE_DURATION.snapshot(agent=agent, node=node)
+        if count:
+            breakdown[node] = total / count
+    return breakdown
+
+
+def prompt_tokens(model="fake-llm", kind="prompt"):
+    count, total = LLM_TOKENS.snapshot(model=model, kind=kind)
+    return total / count if count else 0.0
+
+
+def cached_share(model="fake-llm"):
+    """Share of prompt tokens served from the simulated prefix cache"""
+    _, prompt = LLM_TOKENS.snapshot(model=model, kind="prompt")
+    _, cached = LLM_TOKENS.snapshot(model=model, kind="cached")
+    return cached / prompt if prompt else 0.0
+
+
+SQL_NODES = ["get_all_tables", "get_schema_for_all_tables", "generate_query",
+             "correct_and_optimize_query", "execute_query", "submit_final_answer"]
+VIZ_NODES = ["viz_advice", "create_python_code", "create_visualization"]
+
+
+def bench_sql_agent(args, workdir):
+    from sql_agent import SQLAgent
+
+    db_path = build_chinook(os.path.join(workdir, "chinook.db"), scale=args.scale)
+    agent = SQLAgent(llm=fake_llm(args, sql_by_question={q: sql for q, sql in CHINOOK_QUESTIONS.items()}))
+    agent.add_db("sqlite", db_path=db_path)
+
+    start = time.perf_counter()
+    agent.warmup()
+    warmup_s = time.perf_counter() - start
+
+    latencies = []
+    for _ in range(args.iterations):
+        for question in CHINOOK_QUESTIONS:
+            start = time.perf_counter()
+            agent.graph_workflow(f"What are the {question}?")
+            latencies.append(time.perf_counter() - start)
+
+    db_count, db_total = DB_QUERY_DURATION.snapshot(dialect="sqlite")
+    return {
+        "warmup_s": warmup_s,
+        **summarize(latencies),
+        "nodes_mean_s": node_breakdown("sql_agent", SQL_NODES),
+        "db_query_mean_s": db_total / db_count if db_count else 0.0,
+        "prompt_tokens_mean": prompt_tokens(),
+        "cached_prompt_share": cached_share(),
+    }
+
+
+def bench_sql_agent_wide(args, workdir):
+    from sql_agent import SQLAgent
+
+    db_path = build_wide_schema(os.path.join(workdir, "wide.db"), tables=args.wide_tables, columns=args.wide_columns)
+    agent = SQLAgent(llm=fake_llm(args, sql_by_question={"rows": "SELECT COUNT(*) FROM wide_table_0"}))
+    agent.add_db("sqlite", db_path=db_path)
+
+    start = time.perf_counter()
+    agent.warmup()
+    warmup_s = time.perf_counter() - start
+
+    latencies = []
+    for _ in range(args.iterations):
+        start = time.perf_counter()
+        agent.graph_workflow("How many rows are in the first wide table?")
+        latencies.append(time.perf_counter() - start)
+
+    return {
+        "tables": args.wide_tables,
+        "columns": args.wide_columns,
+        "warmup_s": warmup_s,
+        **summarize(latencies),
+        "nodes_mean_s": node_breakdown("sql_agent", SQL_NODES),
+        "prompt_tokens_mean": prompt_tokens(),
+        "cached_prompt_share": cached_share(),
+    }
+
+
+def bench_csv_ingest(args, workdir):
+    import sqlite3
+    from csv_refresh import load_csv
+    from sql_agent import SQLAgent
+
+    def extra_field_append():
+        # An appended row with a field too many must not be stored with the extra field dropped
+        path, db_path = os.path.join(workdir, "fields.csv"), os.path.join(workdir, "fields.db")
+        with open(path, "w") as f:
+            f.write("id,name,score\n1,a,1.5\n")
+        load_csv(path, db_path, "fields")
+        with open(path, "a") as f:
+            f.write("5,d,5,EXTRA\n")
+        try:
+            load_csv(path, db_path, "fields")
+        except Exception:
+            pass
+        conn = sqlite3.connect(db_path)
+        try:
+            stored = conn.execute("SELECT COUNT(*) FROM fields").fetchone()[0]
+        finally:
+            conn.close()
+        return {"rows_stored": stored, "rejected": stored == 1}
+
+    csv_path = build_large_csv(os.path.join(workdir, "orders.csv"), rows=args.csv_rows)
+    size_mb = os.path.getsize(csv_path) / 1e6
+    current = os.getcwd()
+    os.chdir(workdir)
+    try:
+        agent = SQLAgent(llm=fake_llm(args))
+        start = time.perf_counter()
+        agent.add_db("csv", file_path=csv_path)
+        ingest_s = time.perf_counter() - start
+
+        start = time.perf_counter()
+        agent.warmup()
+        warmup_s = time.perf_counter() - start
+
+        # Re-upload the file with 1% more rows appended, as a daily export would be
+        with open(csv_path) as f:
+            next(f)
+            appended = [line for _, line in zip(range(max(1, args.csv_rows // 100)), f)]
+        with open(csv_path, "a") as f:
+            f.writelines(appended)
+        start = time.perf_counter()
+        agent.add_db("csv", file_path=csv_path)
+        agent.warmup()
+        refresh_s = time.perf_counter() - start
+        refresh_mode = agent.refresh_report["mode"]
+    finally:
+        os.chdir(current)
+
+    return {
+        "rows": args.csv_rows,
+        "size_mb": size_mb,
+        "ingest_s": ingest_s,
+        "ingest_mb_per_s": size_mb / ingest_s if ingest_s else 0.0,
+        "warmup_s": warmup_s,
+        "append_refresh_s": refresh_s,
+        "append_refresh_mode": refresh_mode,
+        "extra_field_append": extra_field_append(),
+    }
+
+
+def bench_multi_file_ingest(args, workdir):
+    """A zip of one CSV per Chinook table, loaded into one table per file with inferred relationships"""
+    from sql_agent import SQLAgent
+
+    archive = build_csv_directory(os.path.join(workdir, "chinook_csv"), scale=args.scale, archive=True)
+    current = os.getcwd()
+    os.chdir(workdir)
+    try:
+        agent = SQLAgent(llm=fake_llm(args))
+        start = time.perf_counter()
+        agent.add_db("csv", file_path=archive)
+        ingest_s = time.perf_counter() - start
+    finally:
+        os.chdir(current)
+
+    report = agent.ingestion_report
+    return {
+        "ingest_s": ingest_s,
+        "relationships": len(report["relationships"]),
+        "files": {f["file"]: {"rows": f["rows"], "mb_per_s": f["mb_per_s"]} for f in report["files"]},
+    }
+
+
+def bench_viz_agent(args, workdir):
+    from visualization_agent import VisualizationAgent
+
+    agent = VisualizationAgent(llm=fake_llm(args))
+    start = time.perf_counter()
+    agent.warmup()
+    warmup_s = time.perf_counter() - start
+
+    result_text = "\n".join(f"- {genre}: {count} tracks" for genre, count in
+                            [("Rock", 835), ("Jazz", 130), ("Metal", 264), ("Latin", 391), ("Blues", 81)])
+    latencies = []
+    for _ in range(args.iterations):
+        start = time.perf_counter()
+        agent.graph_workflow(result_text)
+        latencies.append(time.perf_counter() - start)
+
+    count, total = metrics.VIZ_PAYLOAD_BYTES.snapshot()
+    return {
+        "warmup_s": warmup_s,
+        **summarize(latencies),
+        "nodes_mean_s": node_breakdown("visualization_agent", VIZ_NODES),
+        "payload_bytes_mean": total / count if count else 0.0,
+    }
+
+
+def setup_api(args, workdir):
+    """Point the API module at fake-LLM agents connected to a Chinook fixture"""
+    import api
+    from sql_agent import SQLAgent
+    from visualization_agent import VisualizationAgent
+
+    db_path = build_chinook(os.path.join(workdir, "chinook_api.db"), scale=args.scale)
+    sql_by_question = {q: sql for q, sql in CHINOOK_QUESTIONS.items()}
+    api._sql_agent = SQLAgent(llm=fake_llm(args, sql_by_question=sql_by_question))
+    api._viz_agent = VisualizationAgent(llm=fake_llm(args))
+    api._llm = fake_llm(args)
+    api._sql_agent.add_db("sqlite", db_path=db_path)
+    api._sql_agent.warmup()
+    api._viz_agent.warmup()
+    return api
+
+
+def bench_api(args, workdir):
+    import httpx
+
+    api = setup_api(args, workdir)
+
+    questions = list(CHINOOK_QUESTIONS)
+    results = {}
+
+    async def run_level(concurrency):
+        transport = httpx.ASGITransport(app=api.app)
+        latencies, errors = [], 0
+        async with httpx.AsyncClient(transport=transport, base_url="http://bench", timeout=None) as client:
+            async def worker(worker_id):
+                nonlocal errors
+                for i in range(args.requests_per_client):
+                    question = questions[(worker_id + i) % len(questions)]
+                    payload = {"query": f"What are the {question}?", "vizEnabled": args.viz, "tabularMode": False}
+                    start = time.perf_counter()
+                    response = await client.post("/query", json=payload)
+                    latencies.append(time.perf_counter() - start)
+                    if response.status_code != 200:
+                        errors += 1
+
+            start = time.perf_counter()
+            await asyncio.gather(*(worker(w) for w in range(concurrency)))
+            elapsed = time.perf_counter() - start
+        return {
+            "clients": concurrency,
+            "requests": len(latencies),
+            "errors": errors,
+            "throughput_rps": len(latencies) / elapsed if elapsed else 0.0,
+            **summarize(latencies),
+        }
+
+    current = os.getcwd()
+    os.chdir(workdir)
+    try:
+        for concurrency in args.concurrency:
+            results[f"clients_{concurrency}"] = asyncio.run(run_level(concurrency))
+    finally:
+        os.chdir(current)
+
+    stages = {}
+    for stage in ("sql", "singularity_check", "visualization"):
+        count, total = STAGE_DURATION.snapshot(stage=stage)
+        if count:
+            stages[stage] = total / count
+    results["stages_mean_s"] = stages
+    return results
+
+
+def bench_api_batch(args, workdir):
+    import httpx
+
+    api = setup_api(args, workdir)
+    questions = [f"What are the {question}?" for question in CHINOOK_QUESTIONS] * args.iterations
+
+    async def run_batch(max_concurrency):
+        transport = httpx.ASGITransport(app=api.app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://bench", timeout=None) as client:
+            start = time.perf_counter()
+            response = await client.post("/query/batch", json={
+                "queries": questions, "vizEnabled": args.viz, "max_concurrency": max_concurrency})
+            elapsed = time.perf_counter() - start
+        items = response.json()["results"]
+        return {
+            "questions": len(questions),
+            "errors": sum(1 for item in items if item["error"]),
+            "elapsed_s": elapsed,
+            "questions_per_s": len(questions) / elapsed if elapsed else 0.0,
+        }
+
+    results = {}
+    current = os.getcwd()
+    os.chdir(workdir)
+    try:
+        for concurrency in args.concurrency:
+            results[f"max_concurrency_{concurrency}"] = asyncio.run(run_batch(concurrency))
+    finally:
+        os.chdir(current)
+    return results
+
+
+def bench_llm_limiter(args, workdir):
+    """Mixed interactive and batch traffic against a rate-limited local OpenAI server"""
+    from concurrent.futures import ThreadPoolExecutor
+    from langchain_openai import ChatOpenAI
+    from fake_openai_server import FakeOpenAIServer
+    from llm_limiter import LLMLimiter
+
+    server = FakeOpenAIServer(latency=args.latency, requests_per_second=args.llm_rps,
+                              capacity=args.llm_capacity).start()
+    llm = ChatOpenAI(model="gpt-4o-mini", base_url=server.base_url, api_key="offline", max_retries=0,
+                     callbacks=[metrics.llm_callback_handler()])
+    clients = max(args.concurrency)
+    priorities = ["interactive" if i % 2 == 0 else "batch" for i in range(clients)]
+
+    def run(limiter):
+        latencies = {"interactive": [], "batch": []}
+        errors = {"interactive": 0, "batch": 0}
+
+        def client(priority):
+            for i in range(args.requests_per_client):
+                start = time.perf_counter()
+                try:
+                    if limiter is None:
+                        llm.invoke(f"{priority} question {i}")
+                    else:
+                        limiter.invoke(llm, f"{priority} question {i}", priority=priority)
+                    latencies[priority].append(time.perf_counter() - start)
+                except Exception:
+                    errors[priority] += 1
+
+        server.stats.update(requests=0, rate_limited=0, max_in_flight=0)
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=clients) as executor:
+            list(executor.map(client, priorities))
+        result = {"elapsed_s": time.perf_counter() - start, **dict(server.stats)}
+        for priority in latencies:
+            result[priority] = {**summarize(latencies[priority]), "errors": errors[priority]}
+        if limiter is not None:
+            result["final_concurrency_limit"] = limiter.limit
+        return result
+
+    def token_budget(calls=5, prompt_seconds=0.5):
+        # Prompts several times the bucket's burst must still be paced at the TPM rate
+        limiter = LLMLimiter(tokens_per_minute=600_000, burst_seconds=0.1, expected_completion_tokens=0)
+        tokens = int(limiter.tokens.rate * prompt_seconds)
+        start = time.perf_counter()
+        for _ in range(calls):
+            limiter.call(lambda: None, tokens)
+        elapsed, expected = time.perf_counter() - start, (calls - 1) * prompt_seconds
+        return {"prompt_tokens": tokens, "elapsed_s": elapsed, "expected_s": expected,
+                "within_budget": elapsed >= 0.9 * expected}
+
+    try:
+        return {
+            "unlimited": run(None),
+            "limiter": run(LLMLimiter(requests_per_minute=args.llm_rps * 60, tokens_per_minute=10_000_000,
+                                      max_retries=8)),
+            "token_budget": token_budget(),
+        }
+    finally:
+        server.stop()
+
+
+BENCHMARKS = {
+    "sql_agent": bench_sql_agent,
+    "sql_agent_wide": bench_sql_agent_wide,
+    "csv_ingest": bench_csv_ingest,
+    "viz_agent": bench_viz_agent,
+    "api": bench_api,
+    "api_batch": bench_api_batch,
+    "llm_limiter": bench_llm_limiter,
+    "multi_file_ingest": bench_multi_file_ingest,
+}
+
+
+def peak_rss_mb():
+    # ru_maxrss is reported in kilobytes on Linux and bytes on macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / 1e6 if sys.platform == "darwin" else peak / 1e3
+
+
+def print_result(name, result, indent="  "):
+    print(f"{indent}{name}:")
+    for key, value in result.items():
+        if isinstance(value, dict):
+            print_result(key, value, indent + "  ")
+        elif isinstance(value, float):
+            print(f"{indent}  {key}: {value:.4f}")
+        else:
+            print(f"{indent}  {key}: {value}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Offline TalkQL benchmarks with a fake LLM")
+    parser.add_argument("--scenarios", default=",".join(SCENARIOS))
+    parser.add_argument("--iterations", type=int, default=5)
+    parser.add_argument("--latency", type=float, default=0.05, help="Fake LLM latency per call in seconds")
+    parser.add_argument("--latency-per-1k-tokens", type=float, default=0.0)
+    parser.add_argument("--scale", type=int, default=1, help="Row multiplier for the Chinook fixture")
+    parser.add_argument("--wide-tables", type=int, default=120)
+    parser.add_argument("--wide-columns", type=int, default=60)
+    parser.add_argument("--csv-rows", type=int, default=500_000)
+    parser.add_argument("--concurrency", default="1,4,16")
+    parser.add_argument("--requests-per-client", type=int, default=4)
+    parser.add_argument("--llm-rps", type=int, default=20, help="Request quota of the fake OpenAI server")
+    parser.add_argument("--llm-capacity", type=int, default=8,
+                        help="Concurrent requests the fake OpenAI server serves before slowing down")
+    parser.add_argument("--viz", action="store_true", help="Enable visualization in the api scenario")
+    parser.add_argument("--tracemalloc", action="store_true", help="Report Python heap peak per scenario (slower)")
+    parser.add_argument("--json", help="Write the results to this file")
+    args = parser.parse_args()
+    args.concurrency = [int(c) for c in args.concurrency.split(",")]
+    logging.basicConfig(level=os.environ["TALKQL_LOG_LEVEL"])
+    # Missing-font warnings from matplotlib would drown the report
+    logging.getLogger("matplotlib").setLevel(logging.ERROR)
+
+    results = {}
+    with tempfile.TemporaryDirectory(prefix="talkql-bench-") as workdir:
+        for name in args.scenarios.split(","):
+            metrics.REGISTRY.reset()
+            if args.tracemalloc:
+                tracemalloc.start()
+            start = time.perf_counter()
+            result = BENCHMARKS[name](args, workdir)
+            result["scenario_s"] = time.perf_counter() - start
+            if args.tracemalloc:
+                result["heap_peak_mb"] = tracemalloc.get_traced_memory()[1] / 1e6
+                tracemalloc.stop()
+            result["peak_rss_mb"] = peak_rss_mb()
+            results[name] = result
+            print_result(name, result)
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
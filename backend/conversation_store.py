@@ -0,0 +1,79 @@
+from collections import OrderedDict
+import threading
+import time
+
+from langgraph.checkpoint.memory import MemorySaver
+
+
+class ConversationStore(MemorySaver):
+    """
+    In-memory checkpointer for conversation threads with bounded memory.
+
+    Only the latest checkpoints of each thread are kept, and threads that have been
+    idle for longer than `idle_ttl` seconds, or exceed `max_threads`, are evicted.
+    """
+
+    def __init__(self, max_threads: int = 500, idle_ttl: float = 1800, keep_checkpoints: int = 2):
+        super().__init__()
+        self.max_threads = max_threads
+        self.idle_ttl = idle_ttl
+        self.keep_checkpoints = keep_checkpoints
+        self._last_used = OrderedDict()
+        self._lock = threading.Lock()
+
+    def touch(self, thread_id: str):
+        """Mark a thread as active and evict idle or least recently used threads"""
+        now = time.monotonic()
+        with self._lock:
+            self._last_used[thread_id] = now
+            self._last_used.move_to_end(thread_id)
+            while self._last_used:
+                oldest, last_used = next(iter(self._last_used.items()))
+                if oldest == thread_id:
+                    break
+                if len(self._last_used) <= self.max_threads and now - last_used <= self.idle_ttl:
+                    break
+                self._delete(oldest)
+
+    def delete_thread(self, thread_id: str):
+        with self._lock:
+            self._delete(thread_id)
+
+    def clear(self):
+        with self._lock:
+            self.storage.clear()
+            self.writes.clear()
+            self._last_used.clear()
+
+    def __len__(self):
+        return len(self._last_used)
+
+    def _delete(self, thread_id: str):
+        """Drop a thread; the caller holds self._lock"""
+        self._last_used.pop(thread_id, None)
+        self.storage.pop(thread_id, None)
+        for key in [key for key in self.writes if key[0] == thread_id]:
+            self.writes.pop(key, None)
+
+    def put(self, config, checkpoint, metadata, new_versions):
+        # Shares the lock with eviction, which drops whole threads from the same dicts
+        with self._lock:
+            result = super().put(config, checkpoint, metadata, new_versions)
+            # Every graph step writes a checkpoint holding the full message list;
+            # older ones are never read again, so drop them
+            thread_id = config["configurable"]["thread_id"]
+            # A thread evicted while its run was still in flight is stored again here;
+            # keep tracking it so the next touch() can evict it
+            self._last_used.setdefault(thread_id, time.monotonic())
+            checkpoint_ns = config["configurable"].get("checkpoint_ns", "")
+            checkpoints = self.storage[thread_id][checkpoint_ns]
+            if len(checkpoints) > self.keep_checkpoints:
+                # Checkpoint ids are time-ordered, so the oldest sort first
+                for checkpoint_id in sorted(checkpoints)[:-self.keep_checkpoints]:
+                    checkpoints.pop(checkpoint_id, None)
+                    self.writes.pop((thread_id, checkpoint_ns, checkpoint_id), None)
+        return result
+
+    def put_writes(self, config, writes, task_id):
+        with self._lock:
+            return super().put_writes(config, writes, task_id)
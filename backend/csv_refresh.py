@@ -0,0 +1,196 @@
+"""
+Reload a CSV file into SQLite, parsing only the rows appended since the last load.
+
+The database remembers the size and SHA-256 of the file each table was loaded
+from in STATE_TABLE. When the file is loaded again and its first `size` bytes
+still hash to the recorded value, it was only appended to: just the new byte
+range is parsed and inserted, in the same transaction that updates the state.
+If the header or any earlier content changed, the table is rebuilt from
+scratch in a staging database that replaces the old one once complete.
+
+Column statistics are gathered from the chunks as they are parsed and stored
+with the state, merged with the new rows' on append, so the table's profile
+never has to be queried back.
+"""
+import csv
+import hashlib
+import io
+import json
+import logging
+import os
+import sqlite3
+import tempfile
+import time
+
+from ingestion import CHUNK_ROWS
+from metrics import CSV_REFRESHES, INGEST_BYTES
+from profiling import chunk_stats, merge_stats, stats_profile
+
+logger = logging.getLogger(__name__)
+
+STATE_TABLE = "talkql_csv_sources"
+HASH_CHUNK = 8 * 1024 * 1024
+
+
+def hash_file(path: str, prefix_size: int = 0):
+    """(SHA-256 of the first prefix_size bytes or None if the file is shorter, SHA-256 of the whole file)"""
+    digest, prefix, position = hashlib.sha256(), None, 0
+    with open(path, "rb") as f:
+        while True:
+            if position == prefix_size:
+                prefix = digest.hexdigest()
+            chunk = f.read(min(HASH_CHUNK, prefix_size - position) if position < prefix_size else HASH_CHUNK)
+            if not chunk:
+                break
+            digest.update(chunk)
+            position += len(chunk)
+    return prefix, digest.hexdigest()
+
+
+def ends_with_newline(path: str) -> bool:
+    with open(path, "rb") as f:
+        f.seek(-1, os.SEEK_END)
+        return f.read(1) in (b"\n", b"\r")
+
+
+def load_state(db_path: str, table: str):
+    if not os.path.exists(db_path):
+        return None
+    conn = sqlite3.connect(db_path)
+    try:
+        row = conn.execute(f"SELECT size, sha256, delimiter, ends_with_newline, stats FROM {STATE_TABLE} "
+                           f"WHERE table_name = ?", (table,)).fetchone()
+    except sqlite3.OperationalError:
+        # Loaded by an older version or by the multi-file ingestion
+        return None
+    finally:
+        conn.close()
+    if not row:
+        return None
+    state = dict(zip(("size", "sha256", "delimiter", "ends_with_newline"), row))
+    state["stats"] = json.loads(row[4])
+    return state
+
+
+def save_state(conn, table: str, path: str, sha256: str, delimiter: str, stats: dict):
+    conn.execute(f"CREATE TABLE IF NOT EXISTS {STATE_TABLE} (table_name TEXT PRIMARY KEY, size INTEGER, "
+                 f"sha256 TEXT, delimiter TEXT, ends_with_newline INTEGER, stats TEXT)")
+    conn.execute(f"INSERT OR REPLACE INTO {STATE_TABLE} VALUES (?, ?, ?, ?, ?, ?)",
+                 (table, os.path.getsize(path), sha256, delimiter, ends_with_newline(path), json.dumps(stats)))
+
+
+def _rows_fit(f, delimiter: str, width: int) -> bool:
+    """Whether every row from the position of binary file f on has exactly `width` fields"""
+    text = io.TextIOWrapper(f, encoding="utf-8", errors="replace", newline="")
+    try:
+        # pandas pads short rows with NULLs and can drop the extra fields of long ones, so count them first
+        return all(len(fields) == width for fields in csv.reader(text, delimiter=delimiter) if fields)
+    finally:
+        text.detach()
+
+
+def _append(path: str, db_path: str, table: str, delimiter: str, state: dict, sha256: str, chunksize: int):
+    """
+    Insert the rows after the recorded size and return (rows, statistics of the whole table),
+    or None if they don't continue the loaded rows
+    """
+    import pandas as pd
+
+    with open(path, "rb") as f:
+        f.seek(state["size"])
+        if not state["ends_with_newline"] and f.read(1) not in (b"\n", b"\r"):
+            # The old last row was extended rather than followed by new rows
+            return None
+        conn = sqlite3.connect(db_path, isolation_level=None)
+        try:
+            columns = [row[1] for row in conn.execute(f'PRAGMA table_info("{table}")')]
+            position = f.tell()
+            if not _rows_fit(f, delimiter, len(columns)):
+                logger.warning(f"Appended rows of {os.path.basename(path)} don't have the {len(columns)} fields "
+                               f"of the loaded ones")
+                return None
+            f.seek(position)
+            insert = f'INSERT INTO "{table}" VALUES ({", ".join("?" * len(columns))})'
+            rows, stats = 0, state["stats"]
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                for chunk in pd.read_csv(f, sep=delimiter, header=None, names=columns, on_bad_lines="error",
+                                         chunksize=chunksize):
+                    stats = merge_stats(stats, chunk_stats(chunk))
+                    chunk = chunk.astype(object).where(chunk.notna(), None)
+                    conn.executemany(insert, chunk.values.tolist())
+                    rows += len(chunk)
+                save_state(conn, table, path, sha256, delimiter, stats)
+                conn.execute("COMMIT")
+            except pd.errors.ParserError as e:
+                conn.execute("ROLLBACK")
+                logger.warning(f"Appended rows of {os.path.basename(path)} don't parse like the loaded ones: {str(e)}")
+                return None
+            except BaseException:
+                conn.execute("ROLLBACK")
+                raise
+        finally:
+            conn.close()
+    return rows, stats
+
+
+def _rebuild(path: str, db_path: str, table: str, delimiter: str, sha256: str, chunksize: int):
+    """Load the whole file into a staging database and swap it in; returns (rows, statistics)"""
+    import pandas as pd
+
+    fd, staging = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(db_path)), suffix=".db")
+    os.close(fd)
+    try:
+        conn = sqlite3.connect(staging)
+        try:
+            rows, stats = 0, None
+            for chunk in pd.read_csv(path, sep=delimiter, chunksize=chunksize):
+                chunk.to_sql(table, conn, if_exists="append", index=False)
+                stats = merge_stats(stats, chunk_stats(chunk))
+                rows += len(chunk)
+            save_state(conn, table, path, sha256, delimiter, stats)
+            conn.commit()
+        finally:
+            conn.close()
+        os.replace(staging, db_path)
+    except BaseException:
+        if os.path.exists(staging):
+            os.remove(staging)
+        raise
+    return rows, stats
+
+
+def load_csv(path: str, db_path: str, table: str = "csv_data", delimiter: str = ",", incremental: bool = True,
+             chunksize: int = CHUNK_ROWS):
+    """
+    Load a CSV file into `table` of the SQLite database at db_path, only appending the new
+    rows when the file grew by appending since it was last loaded there.
+
+    Returns ({"mode": "unchanged" | "append" | "full", "rows": ..., "bytes": ..., "seconds": ...},
+    profile of the whole table) where rows and bytes count what was parsed.
+    """
+    start = time.perf_counter()
+    size = os.path.getsize(path)
+    state = load_state(db_path, table) if incremental else None
+    if state and (state["delimiter"] != delimiter or size < state["size"]):
+        state = None
+    prefix, sha256 = hash_file(path, state["size"] if state else 0)
+
+    mode, loaded, parsed = "full", None, size
+    if state and prefix == state["sha256"]:
+        if size == state["size"]:
+            mode, loaded, parsed = "unchanged", (0, state["stats"]), 0
+        else:
+            loaded = _append(path, db_path, table, delimiter, state, sha256, chunksize)
+            mode, parsed = "append", size - state["size"]
+    if loaded is None:
+        mode, parsed = "full", size
+        loaded = _rebuild(path, db_path, table, delimiter, sha256, chunksize)
+    rows, stats = loaded
+
+    CSV_REFRESHES.inc(mode=mode)
+    INGEST_BYTES.inc(parsed, format="csv")
+    report = {"mode": mode, "rows": rows, "bytes": parsed, "seconds": time.perf_counter() - start}
+    logger.info(f"Loaded {os.path.basename(path)} into {table} ({mode}): {rows} rows from {parsed} bytes "
+                f"in {report['seconds']:.2f}s")
+    return report, stats_profile(stats) if stats else None
@@ -0,0 +1,162 @@
+"""
+On-disk cache for remote SQLite databases and CSV files.
+
+Downloads are streamed to disk in chunks while being hashed, then stored under
+their SHA-256 so identical content is kept once. Each URL remembers its ETag and
+Last-Modified, and fetching it again sends a conditional request: an unchanged
+file costs a 304 with no body instead of a full transfer. The least recently
+used files are evicted once the cache grows past its size cap.
+
+Configure with TALKQL_DOWNLOAD_CACHE_DIR and TALKQL_DOWNLOAD_CACHE_MB.
+"""
+import hashlib
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+from typing import NamedTuple
+
+from metrics import DOWNLOADS, DOWNLOAD_BYTES
+
+logger = logging.getLogger(__name__)
+
+CHUNK_SIZE = 1024 * 1024
+
+
+class Download(NamedTuple):
+    path: str
+    content_type: str
+    sha256: str
+
+
+class DownloadCache:
+    def __init__(self, directory: str = None, max_bytes: int = None, timeout: float = 60):
+        self.directory = directory or os.getenv("TALKQL_DOWNLOAD_CACHE_DIR", "download_cache")
+        self.max_bytes = max_bytes or int(os.getenv("TALKQL_DOWNLOAD_CACHE_MB", 2048)) * 1024 * 1024
+        self.timeout = timeout
+        self._lock = threading.Lock()
+
+    @property
+    def index_path(self):
+        return os.path.join(self.directory, "index.json")
+
+    def object_path(self, sha256: str):
+        return os.path.join(self.directory, "objects", sha256[:2], sha256)
+
+    def _load_index(self):
+        try:
+            with open(self.index_path) as f:
+                return json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return {}
+
+    def _save_index(self, index):
+        os.makedirs(self.directory, exist_ok=True)
+        fd, tmp = tempfile.mkstemp(dir=self.directory, suffix=".json")
+        with os.fdopen(fd, "w") as f:
+            json.dump(index, f)
+        os.replace(tmp, self.index_path)
+
+    def fetch(self, url: str, headers: dict = None) -> Download:
+        """Return a local copy of url, downloading it only if the cached copy is missing or stale"""
+        import requests
+
+        with self._lock:
+            entry = self._load_index().get(url)
+        if entry and not os.path.exists(self.object_path(entry["sha256"])):
+            entry = None
+
+        request_headers = dict(headers or {})
+        if entry and entry.get("etag"):
+            request_headers["If-None-Match"] = entry["etag"]
+        if entry and entry.get("last_modified"):
+            request_headers["If-Modified-Since"] = entry["last_modified"]
+
+        try:
+            response = requests.get(url, headers=request_headers, stream=True, timeout=self.timeout)
+        except requests.RequestException as e:
+            if entry is None:
+                raise
+            # Reconnecting while the origin is unreachable: the last copy is better than nothing
+            logger.warning(f"Could not revalidate {url}, using the cached copy: {str(e)}")
+            DOWNLOADS.inc(result="stale")
+            return self._use(url, entry)
+
+        with response:
+            if response.status_code == 304 and entry:
+                DOWNLOADS.inc(result="revalidated")
+                return self._use(url, entry)
+            if response.status_code != 200:
+                raise ValueError(f"Failed to download {url}. Status code: {response.status_code}")
+            entry = self._store(response)
+        entry.update(etag=response.headers.get("ETag"), last_modified=response.headers.get("Last-Modified"),
+                     content_type=response.headers.get("Content-Type", ""))
+        DOWNLOADS.inc(result="downloaded")
+        DOWNLOAD_BYTES.inc(entry["size"])
+        return self._use(url, entry)
+
+    def _store(self, response):
+        """Stream a response body into the object store under its content hash"""
+        os.makedirs(self.directory, exist_ok=True)
+        digest, size = hashlib.sha256(), 0
+        fd, tmp = tempfile.mkstemp(dir=self.directory, suffix=".part")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                for chunk in response.iter_content(chunk_size=CHUNK_SIZE):
+                    f.write(chunk)
+                    digest.update(chunk)
+                    size += len(chunk)
+            sha256 = digest.hexdigest()
+            path = self.object_path(sha256)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            # Identical content downloaded from another URL is already stored
+            if os.path.exists(path):
+                os.remove(tmp)
+            else:
+                os.replace(tmp, path)
+        except BaseException:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+            raise
+        return {"sha256": sha256, "size": size}
+
+    def _use(self, url, entry):
+        with self._lock:
+            index = self._load_index()
+            entry["last_used"] = time.time()
+            index[url] = entry
+            self._evict(index, keep=entry["sha256"])
+            self._save_index(index)
+        return Download(self.object_path(entry["sha256"]), entry.get("content_type", ""), entry["sha256"])
+
+    def _evict(self, index, keep):
+        """Drop the least recently used files until the cache fits its cap"""
+        sizes, last_used = {}, {}
+        for entry in index.values():
+            sizes[entry["sha256"]] = entry["size"]
+            last_used[entry["sha256"]] = max(last_used.get(entry["sha256"], 0), entry["last_used"])
+        total = sum(sizes.values())
+        for sha256 in sorted(last_used, key=last_used.get):
+            if total <= self.max_bytes:
+                break
+            if sha256 == keep:
+                continue
+            for url in [url for url, entry in index.items() if entry["sha256"] == sha256]:
+                del index[url]
+            try:
+                os.remove(self.object_path(sha256))
+            except FileNotFoundError:
+                pass
+            total -= sizes[sha256]
+            logger.info(f"Evicted {sha256[:12]} ({sizes[sha256]} bytes) from the download cache")
+
+    def clear(self):
+        with self._lock:
+            for entry in self._load_index().values():
+                try:
+                    os.remove(self.object_path(entry["sha256"]))
+                except FileNotFoundError:
+                    pass
+            self._save_index({})
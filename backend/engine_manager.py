@@ -0,0 +1,144 @@
+"""
+Managed SQLAlchemy engines for the connected databases.
+
+Engines are created once per connection URI with pool settings suited to the
+dialect: pre-ping so connections dropped by the server (MySQL wait_timeout,
+Snowflake session expiry) are replaced instead of failing a query, recycling
+before those limits, and sessions switched to read-only where the database
+supports it. Pool usage is exported on /metrics.
+
+Override the defaults with TALKQL_DB_POOL_SIZE, TALKQL_DB_MAX_OVERFLOW,
+TALKQL_DB_POOL_TIMEOUT and TALKQL_DB_READ_ONLY=0.
+"""
+import logging
+import os
+import threading
+import time
+
+from metrics import DB_POOL_CHECKED_OUT, DB_POOL_OVERFLOW, DB_POOL_WAIT, DB_CONNECTIONS_OPENED
+
+logger = logging.getLogger(__name__)
+
+# Settings on top of SQLAlchemy's defaults (pool_size=5, max_overflow=10, timeout=30)
+POOL_SETTINGS = {
+    "sqlite": {},
+    "postgresql": {"pool_pre_ping": True, "pool_recycle": 1800},
+    # Recycle well inside the server's and any proxy's idle timeout
+    "mysql": {"pool_pre_ping": True, "pool_recycle": 280},
+    "mssql": {"pool_pre_ping": True, "pool_recycle": 1800},
+    # Snowflake sessions are expensive to open, so keep fewer of them and keep them alive
+    "snowflake": {"pool_pre_ping": True, "pool_recycle": 3600, "pool_size": 3, "max_overflow": 5,
+                  "connect_args": {"client_session_keep_alive": True}},
+}
+
+# Statements run on every new connection to make the session read-only
+READ_ONLY_STATEMENTS = {
+    "sqlite": "PRAGMA query_only = ON",
+    "postgresql": "SET SESSION CHARACTERISTICS AS TRANSACTION READ ONLY",
+    "mysql": "SET SESSION TRANSACTION READ ONLY",
+}
+
+
+def timed_queue_pool():
+    """QueuePool recording how long each checkout waited for a free connection, and its overflow"""
+    from sqlalchemy.pool import QueuePool
+
+    class TimedQueuePool(QueuePool):
+        def _do_get(self):
+            start = time.perf_counter()
+            try:
+                return super()._do_get()
+            finally:
+                DB_POOL_WAIT.observe(time.perf_counter() - start, dialect=self._dialect.name)
+                self._record_overflow()
+
+        def _do_return_conn(self, record):
+            # Runs after the checkin event, once a surplus connection has been closed
+            try:
+                super()._do_return_conn(record)
+            finally:
+                self._record_overflow()
+
+        def _record_overflow(self):
+            DB_POOL_OVERFLOW.set(max(0, self.overflow()), dialect=self._dialect.name)
+
+    return TimedQueuePool
+
+
+def pool_settings(dialect: str):
+    settings = dict(POOL_SETTINGS.get(dialect, {"pool_pre_ping": True}))
+    for option, env in (("pool_size", "TALKQL_DB_POOL_SIZE"), ("max_overflow", "TALKQL_DB_MAX_OVERFLOW"),
+                        ("pool_timeout", "TALKQL_DB_POOL_TIMEOUT")):
+        if os.getenv(env):
+            settings[option] = float(os.getenv(env)) if option == "pool_timeout" else int(os.getenv(env))
+    return settings
+
+
+def create_managed_engine(uri: str, read_only: bool = None):
+    from sqlalchemy import create_engine, event
+    from sqlalchemy.engine import make_url
+
+    if read_only is None:
+        read_only = os.getenv("TALKQL_DB_READ_ONLY", "1") != "0"
+    url = make_url(uri)
+    dialect = url.get_backend_name()
+    settings = pool_settings(dialect)
+    if dialect == "sqlite" and url.database in (None, "", ":memory:"):
+        # In-memory databases live in a single connection, which only the default pool keeps
+        settings = {}
+    else:
+        settings["poolclass"] = timed_queue_pool()
+    engine = create_engine(uri, **settings)
+
+    @event.listens_for(engine, "checkout")
+    def on_checkout(*args):
+        DB_POOL_CHECKED_OUT.inc(dialect=dialect)
+
+    @event.listens_for(engine, "checkin")
+    def on_checkin(*args):
+        DB_POOL_CHECKED_OUT.dec(dialect=dialect)
+
+    read_only_statement = READ_ONLY_STATEMENTS.get(dialect) if read_only else None
+
+    @event.listens_for(engine, "connect")
+    def on_connect(dbapi_connection, connection_record):
+        DB_CONNECTIONS_OPENED.inc(dialect=dialect)
+        if read_only_statement:
+            cursor = dbapi_connection.cursor()
+            cursor.execute(read_only_statement)
+            cursor.close()
+            # Session settings made inside a transaction would be undone by the pool's rollback
+            dbapi_connection.commit()
+
+    return engine
+
+
+class EngineManager:
+    """One engine per connection URI, reused across queries until the connection is dropped"""
+
+    def __init__(self):
+        self._engines = {}
+        self._lock = threading.Lock()
+
+    def get(self, uri: str):
+        with self._lock:
+            engine = self._engines.get(uri)
+            if engine is None:
+                engine = self._engines[uri] = create_managed_engine(uri)
+            return engine
+
+    def dispose(self, uri: str):
+        with self._lock:
+            engine = self._engines.pop(uri, None)
+        if engine is not None:
+            engine.dispose()
+
+    def dispose_all(self):
+        with self._lock:
+            engines, self._engines = list(self._engines.values()), {}
+        for engine in engines:
+            engine.dispose()
+        logger.info(f"Disposed {len(engines)} database engine(s)")
+
+
+ENGINES = EngineManager()
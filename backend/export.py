@@ -0,0 +1,384 @@
+"""
+Export the full result of a previously answered query without going through the LLM.
+
+The SQL shown to the user (`query_used`) is re-executed against the connected
+database with the LIMIT the answer was generated with removed. Rows are read
+with server-side cursors in batches and written out as they arrive, so memory
+stays bounded by one batch whatever the size of the result:
+- `stream_export` yields CSV, NDJSON or Parquet (Parquet needs pyarrow, and
+  reads ahead up to PARQUET_SCHEMA_ROWS rows to settle the column types)
+- `fetch_page` returns one page and an opaque cursor for the next one
+
+Pages are read with LIMIT/OFFSET over the query ordered by its own ORDER BY
+followed by every output column, so the order is total and a row can't move
+between pages while the data is unchanged. A row limit the statement keeps
+(full_result off) is lifted and bounds the pages instead. Each page re-runs and
+sorts the query and skips the rows before it, so deep pages get slower and rows
+written between requests can shift the pages; `stream_export` is the way to
+read a large result in full.
+
+Responses carry a `result_handle`, a fingerprint of the connection and SQL,
+that can be exported instead of sending the SQL back.
+"""
+import base64
+import csv
+import hashlib
+import importlib.util
+import io
+import itertools
+import json
+import re
+import threading
+import time
+from collections import OrderedDict
+
+from metrics import EXPORT_ROWS, EXPORT_DURATION
+from sql_rewrite import strip_comments
+
+EXPORT_FORMATS = {
+    "csv": "text/csv",
+    "ndjson": "application/x-ndjson",
+    "parquet": "application/vnd.apache.parquet",
+}
+BATCH_ROWS = 10_000
+# Rows read ahead to settle the column types of a Parquet export
+PARQUET_SCHEMA_ROWS = 100_000
+
+WRITE_KEYWORDS = re.compile(
+    r"\b(insert|update|delete|merge|upsert|drop|alter|create|truncate|grant|revoke|copy|call|exec|execute|into)\b", re.I)
+TRAILING_LIMIT = re.compile(
+    r"\s+(?:limit\s+(?:(?P<skip>\d+)\s*,\s*)?(?P<limit>\d+)(?:\s+offset\s+(?P<offset>\d+))?"
+    r"|(?:offset\s+(?P<rows_offset>\d+)\s+rows?\s+)?fetch\s+(?:first|next)\s+(?P<fetch>\d+)\s+rows?\s+only)\s*$", re.I)
+LEADING_TOP = re.compile(r"^(select\s+(?:distinct\s+)?)top\s*\(?\s*(?P<top>\d+)\s*\)?\s+", re.I)
+
+
+def export_statement(sql: str, full_result: bool = True) -> str:
+    """
+    The statement to export: a single read-only SELECT, with its outermost row limit
+    removed when full_result is set. Raises ValueError for anything else.
+    """
+    statement = strip_comments(sql)
+    # Keywords inside string literals are data, not statements
+    unquoted = re.sub(r"'(?:[^']|'')*'", "''", statement)
+    if not re.match(r"(select|with)\b", statement, re.I) or ";" in unquoted:
+        raise ValueError("Only a single SELECT statement can be exported")
+    if WRITE_KEYWORDS.search(unquoted):
+        raise ValueError("Only read-only queries can be exported")
+    if full_result:
+        statement = LEADING_TOP.sub(r"\1", TRAILING_LIMIT.sub("", statement))
+    return statement
+
+
+def fingerprint(connection_key: str, sql: str) -> str:
+    return hashlib.sha256(f"{connection_key}\0{sql}".encode()).hexdigest()[:24]
+
+
+class ResultHandles:
+    """Handles of recent results, so clients can export them without sending the SQL back"""
+
+    def __init__(self, capacity: int = 1024):
+        self.capacity = capacity
+        self._statements = OrderedDict()
+        self._lock = threading.Lock()
+
+    def add(self, connection_key: str, sql: str) -> str:
+        handle = fingerprint(connection_key, sql)
+        with self._lock:
+            self._statements[handle] = sql
+            self._statements.move_to_end(handle)
+            while len(self._statements) > self.capacity:
+                self._statements.popitem(last=False)
+        return handle
+
+    def get(self, connection_key: str, handle: str):
+        """The SQL of a handle, or None if it is unknown or belongs to another connection"""
+        with self._lock:
+            sql = self._statements.get(handle)
+        if sql is None or fingerprint(connection_key, sql) != handle:
+            return None
+        return sql
+
+
+def encode_cursor(query_fingerprint: str, offset: int) -> str:
+    return base64.urlsafe_b64encode(json.dumps({"q": query_fingerprint, "o": offset}).encode()).decode()
+
+
+def decode_cursor(cursor: str, query_fingerprint: str) -> int:
+    try:
+        state = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+        offset = int(state["o"])
+    except (ValueError, KeyError, TypeError):
+        raise ValueError("Invalid cursor")
+    if state.get("q") != query_fingerprint or offset < 0:
+        raise ValueError("Cursor does not belong to this query")
+    return offset
+
+
+def stream_rows(engine, sql: str, batch_size: int = BATCH_ROWS):
+    """Yield the column names, then the rows in batches of at most batch_size, from a server-side cursor"""
+    from sqlalchemy import text
+
+    with engine.connect() as connection:
+        result = connection.execution_options(stream_results=True, yield_per=batch_size).execute(text(sql))
+        yield list(result.keys())
+        for partition in result.partitions():
+            yield partition
+
+
+def split_row_limit(sql: str):
+    """(sql without its outermost row limit, the limit or None, the rows the limit skips)"""
+    match = TRAILING_LIMIT.search(sql)
+    if match:
+        limit = match.group("limit") or match.group("fetch")
+        skip = match.group("skip") or match.group("offset") or match.group("rows_offset") or 0
+        return sql[:match.start()], int(limit), int(skip)
+    match = LEADING_TOP.match(sql)
+    if match:
+        return LEADING_TOP.sub(r"\1", sql), int(match.group("top")), 0
+    return sql, None, 0
+
+
+def _blank_quoted(sql: str) -> str:
+    """Blank out literals and quoted identifiers, keeping offsets, so their contents can't look like SQL"""
+    return re.sub(r"'(?:[^']|'')*'|\"[^\"]*\"|`[^`]*`|\[[^\]]*\]", lambda m: " " * len(m.group()), sql)
+
+
+def _order_by_start(sql: str) -> int:
+    """Index of the statement's outermost ORDER BY, or -1 if it has none"""
+    unquoted = _blank_quoted(sql)
+    depth, start = 0, -1
+    for match in re.finditer(r"[()]|\border\s+by\b", unquoted, re.I):
+        if match.group() == "(":
+            depth += 1
+        elif match.group() == ")":
+            depth -= 1
+        elif depth == 0:
+            start = match.start()
+    return start
+
+
+def _ordered_positions(order_by: str, columns) -> set:
+    """Positions of the output columns an ORDER BY clause already sorts by, by position or name"""
+    positions = {}
+    for position, column in enumerate(columns, 1):
+        positions.setdefault(column.lower(), position)
+    clause = order_by[re.match(r"order\s+by\s+", order_by, re.I).end():]
+    items, depth, item_start = [], 0, 0
+    for index, char in enumerate(_blank_quoted(clause)):
+        depth += {"(": 1, ")": -1}.get(char, 0)
+        if char == "," and depth == 0:
+            items.append(clause[item_start:index])
+            item_start = index + 1
+    items.append(clause[item_start:])
+
+    ordered = set()
+    for item in items:
+        key = re.sub(r"(\s+(asc|desc))?(\s+nulls\s+(first|last))?\s*$", "", item.strip(), flags=re.I)
+        if key.isdigit():
+            ordered.add(int(key))
+        else:
+            # t.name and "name" sort by the output column name
+            name = key.split(".")[-1].strip().strip('"`[]').lower()
+            if name in positions:
+                ordered.add(positions[name])
+    return ordered
+
+
+def paged_statement(sql: str, columns, dialect: str, offset: int, limit: int) -> str:
+    """sql in a total order, restricted to `limit` rows after the first `offset`"""
+    start = _order_by_start(sql)
+    # Break ties of the query's own ordering by every other output column, in position order;
+    # SQL Server rejects an ORDER BY that names a column twice
+    ordered = _ordered_positions(sql[start:], columns) if start >= 0 else set()
+    tiebreak = ", ".join(str(position) for position in range(1, len(columns) + 1) if position not in ordered)
+    if tiebreak:
+        sql += (", " if start >= 0 else " ORDER BY ") + tiebreak
+    if dialect == "mssql":
+        return f"{sql} OFFSET {offset} ROWS FETCH NEXT {limit} ROWS ONLY"
+    return f"{sql} LIMIT {limit} OFFSET {offset}"
+
+
+def _column_names(connection, sql: str, dialect: str):
+    from sqlalchemy import text
+
+    if dialect == "mssql":
+        # Closing the cursor right after execute cancels the query on SQL Server
+        result = connection.execution_options(stream_results=True).execute(text(sql))
+        columns = list(result.keys())
+        result.close()
+        return columns
+    return list(connection.execute(text(f"{sql} LIMIT 0")).keys())
+
+
+def fetch_page(engine, sql: str, offset: int, page_size: int):
+    """(columns, rows, whether more rows follow) for one page of a query's result"""
+    from sqlalchemy import text
+
+    dialect = engine.dialect.name
+    # A row limit the statement keeps bounds the pages, which are read from the unlimited statement
+    sql, limit, skip = split_row_limit(sql)
+    wanted = page_size + 1 if limit is None else min(page_size + 1, limit - offset)
+    with engine.connect() as connection:
+        columns = _column_names(connection, sql, dialect)
+        if wanted <= 0:
+            return columns, [], False
+        statement = paged_statement(sql, columns, dialect, skip + offset, wanted)
+        rows = [list(row) for row in connection.execute(text(statement))]
+    return columns, rows[:page_size], len(rows) > page_size
+
+
+def _csv_chunks(columns, batches):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(columns)
+    for batch in batches:
+        writer.writerows(batch)
+        yield buffer.getvalue().encode()
+        buffer.seek(0)
+        buffer.truncate()
+    if buffer.tell():
+        yield buffer.getvalue().encode()
+
+
+def _ndjson_chunks(columns, batches):
+    for batch in batches:
+        yield "".join(json.dumps(dict(zip(columns, row)), default=str) + "\n" for row in batch).encode()
+
+
+class _ChunkSink(io.RawIOBase):
+    """Write-only file collecting what the Parquet writer emits until it is drained"""
+
+    def __init__(self):
+        self.chunks = []
+        self.position = 0
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        self.position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self.position
+
+    def drain(self):
+        data, self.chunks = b"".join(self.chunks), []
+        return data
+
+
+def _widen(left, right):
+    """The narrowest Arrow type holding the values of both types, falling back to text"""
+    import pyarrow as pa
+
+    if left == right or pa.types.is_null(right):
+        return left
+    if pa.types.is_null(left):
+        return right
+    if pa.types.is_integer(left) and pa.types.is_integer(right):
+        return pa.int64()
+    if pa.types.is_decimal(left) and pa.types.is_decimal(right):
+        return pa.decimal128(38, max(left.scale, right.scale))
+    numeric = (pa.types.is_integer, pa.types.is_floating)
+    if any(check(left) for check in numeric) and any(check(right) for check in numeric):
+        return pa.float64()
+    return pa.string()
+
+
+def _inferred_type(values):
+    import pyarrow as pa
+
+    try:
+        return pa.array(values).type
+    except (pa.ArrowInvalid, pa.ArrowTypeError):
+        # Mixed values, e.g. numbers and text in one SQLite column
+        return pa.string()
+
+
+def _parquet_array(values, arrow_type):
+    import pyarrow as pa
+
+    if pa.types.is_string(arrow_type):
+        return pa.array([value if value is None or isinstance(value, str) else str(value) for value in values],
+                        type=arrow_type)
+    array = pa.array(values)
+    if array.type == arrow_type:
+        return array
+    try:
+        # A safe cast refuses to truncate or overflow, e.g. 2.5 into an integer column
+        return array.cast(arrow_type)
+    except pa.ArrowInvalid:
+        if not pa.types.is_floating(arrow_type):
+            raise
+        # Integers beyond 2**53 lose precision once a column is widened to float
+        return array.cast(arrow_type, safe=False)
+
+
+def _parquet_chunks(columns, batches, dynamic_types: bool = False):
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    # The first PARQUET_SCHEMA_ROWS rows decide the column types, widened until every one fits
+    # (NULL then int, int then float). A column that is all NULL in them is written as text
+    batches = iter(batches)
+    pending, types, seen = [], [pa.null()] * len(columns), 0
+    for batch in batches:
+        if not batch:
+            continue
+        pending.append(batch)
+        types = [_widen(known, _inferred_type(list(values))) for known, values in zip(types, zip(*batch))]
+        seen += len(batch)
+        if seen >= PARQUET_SCHEMA_ROWS:
+            break
+    else:
+        dynamic_types = False
+    if dynamic_types:
+        # Column types are per value in SQLite, so a later integer column can still hold a float
+        types = [pa.float64() if pa.types.is_integer(known) else known for known in types]
+    schema = pa.schema([pa.field(column, pa.string() if pa.types.is_null(known) else known)
+                        for column, known in zip(columns, types)])
+
+    sink = _ChunkSink()
+    writer = pq.ParquetWriter(sink, schema)
+    # Every batch becomes one row group
+    for batch in itertools.chain(pending, batches):
+        table = pa.Table.from_arrays(
+            [_parquet_array(list(values), field.type) for values, field in zip(zip(*batch), schema)], names=columns)
+        writer.write_table(table)
+        yield sink.drain()
+    writer.close()
+    yield sink.drain()
+
+
+def check_format(fmt: str):
+    if fmt not in EXPORT_FORMATS:
+        raise ValueError(f"Unsupported export format {fmt!r}; use one of {', '.join(EXPORT_FORMATS)}")
+    if fmt == "parquet" and importlib.util.find_spec("pyarrow") is None:
+        raise ValueError("Parquet export requires pyarrow")
+
+
+def stream_export(engine, sql: str, fmt: str, batch_size: int = BATCH_ROWS):
+    """
+    Start executing sql and return a generator of the encoded result. The query runs
+    before this returns, so database errors surface here rather than mid-stream.
+    """
+    check_format(fmt)
+    rows = stream_rows(engine, sql, batch_size)
+    columns = next(rows)
+
+    def batches():
+        start, count = time.perf_counter(), 0
+        try:
+            for batch in rows:
+                count += len(batch)
+                yield batch
+        finally:
+            rows.close()
+            EXPORT_ROWS.inc(count, format=fmt)
+            EXPORT_DURATION.observe(time.perf_counter() - start, format=fmt)
+
+    if fmt == "parquet":
+        return _parquet_chunks(columns, batches(), dynamic_types=engine.dialect.name == "sqlite")
+    writers = {"csv": _csv_chunks, "ndjson": _ndjson_chunks}
+    return writers[fmt](columns, batches())
@@ -0,0 +1,224 @@
+"""
+Load a directory or zip archive of CSV/Parquet files into one SQLite database.
+
+Every file becomes its own table. Files are parsed in parallel by a process
+pool, each worker streaming its file in chunks into a private SQLite file so
+memory stays bounded by `chunksize` rows per worker. The parts are then copied
+into the target database with relationships inferred from matching key column
+names (e.g. orders.customer_id -> customers.customer_id) declared as foreign
+keys, and indexes created on the referencing columns so joins stay fast.
+
+Parquet support needs pyarrow; it is listed in requirements.txt, and a clear error is
+raised if it is missing.
+"""
+from concurrent.futures import ProcessPoolExecutor
+import logging
+import multiprocessing
+import os
+import re
+import shutil
+import sqlite3
+import tempfile
+import time
+import zipfile
+
+from metrics import INGEST_FILE_DURATION, INGEST_BYTES
+
+logger = logging.getLogger(__name__)
+
+SUPPORTED_SUFFIXES = (".csv", ".tsv", ".parquet")
+CHUNK_ROWS = 100_000
+# Below this total size, starting worker processes (each importing pandas) costs more than it saves
+PARALLEL_MIN_BYTES = 32 * 1024 * 1024
+
+
+def is_multi_file_source(path: str) -> bool:
+    """Whether a path needs ingest_files rather than the single CSV loader"""
+    return os.path.isdir(path) or zipfile.is_zipfile(path) or path.lower().endswith(".parquet")
+
+
+def list_files(path: str, workdir: str):
+    """
+    (path, file name) of the supported files of a directory, zip archive or single file;
+    archives are extracted into workdir
+    """
+    if os.path.isdir(path):
+        files = [(os.path.join(root, name), name) for root, _, names in sorted(os.walk(path)) for name in sorted(names)]
+    elif zipfile.is_zipfile(path):
+        files = []
+        with zipfile.ZipFile(path) as archive:
+            for index, member in enumerate(archive.infolist()):
+                name = os.path.basename(member.filename)
+                if member.is_dir() or member.filename.startswith("__MACOSX") or not name:
+                    continue
+                # Extract under a flat, generated path so archive paths can't escape workdir
+                target = os.path.join(workdir, f"{index}_{name}")
+                with archive.open(member) as source, open(target, "wb") as destination:
+                    shutil.copyfileobj(source, destination)
+                files.append((target, name))
+    else:
+        files = [(path, os.path.basename(path))]
+    return [(f, name) for f, name in files if name.lower().endswith(SUPPORTED_SUFFIXES) and not name.startswith(".")]
+
+
+def table_name(file_name: str, taken: set) -> str:
+    stem = os.path.splitext(file_name)[0]
+    name = re.sub(r"\W+", "_", stem).strip("_").lower() or "table"
+    if name[0].isdigit():
+        name = f"t_{name}"
+    unique, suffix = name, 2
+    while unique in taken:
+        unique, suffix = f"{name}_{suffix}", suffix + 1
+    taken.add(unique)
+    return unique
+
+
+def read_chunks(path: str, delimiter: str, chunksize: int):
+    import pandas as pd
+
+    if path.lower().endswith(".parquet"):
+        try:
+            import pyarrow.parquet as pq
+        except ImportError:
+            raise ValueError(f"Reading Parquet files requires pyarrow: {os.path.basename(path)}")
+        for batch in pq.ParquetFile(path).iter_batches(batch_size=chunksize):
+            yield batch.to_pandas()
+    else:
+        sep = "\t" if path.lower().endswith(".tsv") else delimiter
+        yield from pd.read_csv(path, sep=sep, chunksize=chunksize)
+
+
+def normalize(name: str) -> str:
+    return re.sub(r"[\W_]+", "", name).lower()
+
+
+def load_file(path: str, file_name: str, table: str, part_path: str, delimiter: str = ",",
+              chunksize: int = CHUNK_ROWS):
+    """Process pool worker: stream one file into its own SQLite file and describe its key columns"""
+    start = time.perf_counter()
+    rows = 0
+    conn = sqlite3.connect(part_path)
+    try:
+        for chunk in read_chunks(path, delimiter, chunksize):
+            chunk.to_sql(table, conn, if_exists="append", index=False)
+            rows += len(chunk)
+        columns = [row[1] for row in conn.execute(f'PRAGMA table_info("{table}")')]
+        # Id-like columns that are unique and never null can be referenced by other tables
+        keys = []
+        for column in columns:
+            if normalize(column).endswith("id"):
+                non_null, distinct = conn.execute(
+                    f'SELECT COUNT("{column}"), COUNT(DISTINCT "{column}") FROM "{table}"').fetchone()
+                if non_null == distinct == rows > 0:
+                    keys.append(column)
+    finally:
+        conn.close()
+    return {
+        "file": file_name,
+        "table": table,
+        "part": part_path,
+        "rows": rows,
+        "bytes": os.path.getsize(path),
+        "seconds": time.perf_counter() - start,
+        "columns": columns,
+        "keys": keys,
+    }
+
+
+def primary_key(table: str, keys):
+    """The key column identifying a table's rows: `id`, `<table>_id` or `<singular table>_id`"""
+    names = {"id", normalize(table) + "id", normalize(table).rstrip("s") + "id",
+             re.sub(r"es$", "", normalize(table)) + "id"}
+    return next((key for key in keys if normalize(key) in names), None)
+
+
+def infer_relationships(results):
+    """(table, column, referenced table, referenced column) for columns that name another table's key"""
+    primary_keys = {r["table"]: primary_key(r["table"], r["keys"]) for r in results}
+    relationships = []
+    for child in results:
+        for column in child["columns"]:
+            if column == primary_keys[child["table"]]:
+                continue
+            for parent, key in primary_keys.items():
+                if key is None or parent == child["table"]:
+                    continue
+                if normalize(key) == "id":
+                    matches = normalize(column) in (normalize(parent) + "id", normalize(parent).rstrip("s") + "id")
+                else:
+                    matches = normalize(column) == normalize(key)
+                if matches:
+                    relationships.append((child["table"], column, parent, key))
+                    break
+    return primary_keys, relationships
+
+
+def ingest_files(source: str, db_path: str, delimiter: str = ",", max_workers: int = None,
+                 chunksize: int = CHUNK_ROWS):
+    """
+    Load every CSV/Parquet file of a directory or zip archive into `db_path`, one table per file.
+    The database is replaced atomically once everything has loaded.
+
+    Returns a report with per-file throughput and the inferred relationships.
+    """
+    start = time.perf_counter()
+    with tempfile.TemporaryDirectory(prefix="talkql-ingest-") as workdir:
+        files = list_files(source, workdir)
+        if not files:
+            raise ValueError(f"No CSV or Parquet files found in {os.path.basename(source)}")
+        taken = set()
+        jobs = [(path, name, table_name(name, taken), os.path.join(workdir, f"part_{i}.db"), delimiter, chunksize)
+                for i, (path, name) in enumerate(files)]
+
+        workers = min(len(jobs), max_workers or os.cpu_count() or 1)
+        if workers == 1 or sum(os.path.getsize(path) for path, _ in files) < PARALLEL_MIN_BYTES:
+            results = [load_file(*job) for job in jobs]
+        else:
+            # Spawn rather than fork: the API process is multi-threaded
+            with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn")) as pool:
+                results = list(pool.map(load_file, *zip(*jobs)))
+
+        primary_keys, relationships = infer_relationships(results)
+        staging = os.path.join(workdir, "staging.db")
+        conn = sqlite3.connect(staging)
+        try:
+            for result in results:
+                table = result["table"]
+                conn.execute("ATTACH DATABASE ? AS part", (result["part"],))
+                create = conn.execute(
+                    "SELECT sql FROM part.sqlite_master WHERE type = 'table' AND name = ?", (table,)).fetchone()[0]
+                # Declare keys and relationships so they show up in the schema given to the model
+                constraints = []
+                if primary_keys[table]:
+                    constraints.append(f'PRIMARY KEY ("{primary_keys[table]}")')
+                constraints += [f'FOREIGN KEY ("{column}") REFERENCES "{parent}" ("{key}")'
+                                for child, column, parent, key in relationships if child == table]
+                if constraints:
+                    create = create.rstrip().rstrip(")").rstrip() + ",\n  " + ",\n  ".join(constraints) + "\n)"
+                conn.execute(create.replace(f'CREATE TABLE "{table}"', f'CREATE TABLE main."{table}"', 1))
+                conn.execute(f'INSERT INTO main."{table}" SELECT * FROM part."{table}"')
+                conn.commit()
+                conn.execute("DETACH DATABASE part")
+            for child, column, _, _ in relationships:
+                conn.execute(f'CREATE INDEX "ix_{child}_{column}" ON "{child}" ("{column}")')
+            conn.commit()
+        finally:
+            conn.close()
+        shutil.move(staging, db_path)
+
+    files_report = []
+    for result in results:
+        fmt = os.path.splitext(result["file"])[1].lstrip(".").lower()
+        INGEST_FILE_DURATION.observe(result["seconds"], format=fmt)
+        INGEST_BYTES.inc(result["bytes"], format=fmt)
+        report = {key: result[key] for key in ("file", "table", "rows", "bytes", "seconds")}
+        report["mb_per_s"] = result["bytes"] / 1e6 / result["seconds"] if result["seconds"] else 0.0
+        report["rows_per_s"] = result["rows"] / result["seconds"] if result["seconds"] else 0.0
+        logger.info(f"Ingested {report['file']} into {report['table']}: {report['rows']} rows "
+                    f"in {report['seconds']:.2f}s ({report['mb_per_s']:.1f} MB/s)")
+        files_report.append(report)
+    return {
+        "files": files_report,
+        "relationships": [f"{child}.{column} -> {parent}.{key}" for child, column, parent, key in relationships],
+        "seconds": time.perf_counter() - start,
+    }
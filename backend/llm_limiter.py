@@ -0,0 +1,238 @@
+"""
+Shared admission control for every LLM call made by the backend.
+
+All calls go through one LLMLimiter which enforces:
+- token buckets for requests and tokens per minute, sized to the OpenAI quota
+- an adaptive concurrency limit that grows additively while latency is steady
+  and shrinks multiplicatively on 429s or when latency rises
+- strict priorities, so interactive /query traffic is admitted before
+  visualization and batch work
+
+Rate-limited calls are retried with exponential backoff, honouring Retry-After,
+as are server errors, timeouts and connection errors, which the OpenAI clients
+are configured not to retry themselves.
+Configure with TALKQL_LLM_RPM, TALKQL_LLM_TPM, TALKQL_LLM_MAX_CONCURRENCY and
+TALKQL_LLM_MAX_RETRIES.
+"""
+from contextlib import contextmanager
+import contextvars
+import heapq
+import itertools
+import logging
+import os
+import random
+import threading
+import time
+
+from metrics import (LLM_QUEUE_WAIT, LLM_CONCURRENCY_LIMIT, LLM_IN_FLIGHT,
+                     LLM_RATE_LIMITED, LLM_RETRIES)
+
+logger = logging.getLogger(__name__)
+
+PRIORITIES = {"interactive": 0, "visualization": 1, "batch": 2}
+
+_priority = contextvars.ContextVar("llm_priority", default="interactive")
+
+
+@contextmanager
+def llm_priority(name: str):
+    """Set the priority of LLM calls made in this context"""
+    token = _priority.set(name)
+    try:
+        yield
+    finally:
+        _priority.reset(token)
+
+
+@contextmanager
+def lower_llm_priority(name: str):
+    """Run at `name` priority unless the current priority is already lower"""
+    current = _priority.get()
+    with llm_priority(max(current, name, key=PRIORITIES.get)):
+        yield
+
+
+def estimate_tokens(prompt) -> int:
+    """Rough token count of a prompt (four characters per token)"""
+    if hasattr(prompt, "to_messages"):
+        text = "".join(str(message.content) for message in prompt.to_messages())
+    else:
+        text = str(prompt)
+    return max(1, len(text) // 4)
+
+
+def is_rate_limit_error(error) -> bool:
+    return getattr(error, "status_code", None) == 429 or type(error).__name__ == "RateLimitError"
+
+
+def is_transient_error(error) -> bool:
+    """Errors the OpenAI SDK would retry itself: timeouts, connection errors, 408, 409 and 5xx"""
+    status = getattr(error, "status_code", None)
+    if isinstance(status, int):
+        return status in (408, 409) or status >= 500
+    return type(error).__name__ in ("APITimeoutError", "APIConnectionError") or isinstance(
+        error, (TimeoutError, ConnectionError))
+
+
+def model_of(runnable) -> str:
+    """Name of the chat model behind a runnable, looking through bindings and structured output chains"""
+    while runnable is not None:
+        name = getattr(runnable, "model_name", None)
+        if isinstance(name, str):
+            return name
+        runnable = getattr(runnable, "bound", None) or getattr(runnable, "first", None)
+    return "unknown"
+
+
+def retry_after(error):
+    response = getattr(error, "response", None)
+    headers = getattr(response, "headers", None) or {}
+    try:
+        return float(headers.get("retry-after"))
+    except (TypeError, ValueError):
+        return None
+
+
+class TokenBucket:
+    def __init__(self, per_minute: float, burst_seconds: float = 1.0):
+        # Providers enforce per-minute quotas over shorter windows, so only allow a short burst
+        self.rate = per_minute / 60
+        self.capacity = max(1.0, self.rate * burst_seconds)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, amount: float) -> float:
+        """Seconds until `amount` can be taken"""
+        self._refill()
+        # More than the bucket holds is admitted once it is full and paid off as debt
+        amount = min(amount, self.capacity)
+        return 0.0 if self.tokens >= amount else (amount - self.tokens) / self.rate
+
+    def take(self, amount: float):
+        # The full amount is charged; a negative balance makes later calls wait until it is repaid
+        self._refill()
+        self.tokens -= amount
+
+
+class LLMLimiter:
+    def __init__(self, requests_per_minute=500, tokens_per_minute=200_000, initial_concurrency=8,
+                 min_concurrency=1, max_concurrency=64, latency_tolerance=2.0, max_retries=5,
+                 expected_completion_tokens=500, burst_seconds=1.0):
+        self.requests = TokenBucket(requests_per_minute, burst_seconds)
+        self.tokens = TokenBucket(tokens_per_minute, burst_seconds)
+        self.limit = float(initial_concurrency)
+        self.min_concurrency = min_concurrency
+        self.max_concurrency = max_concurrency
+        self.latency_tolerance = latency_tolerance
+        self.max_retries = max_retries
+        self.expected_completion_tokens = expected_completion_tokens
+
+        self._cond = threading.Condition()
+        self._queue = []
+        self._sequence = itertools.count()
+        self._active = 0
+        self._paused_until = 0.0
+        # Fast and slow moving averages of latency per model; the fast one rising above
+        # the slow one means overload. Models differ too much in latency to share them.
+        self._latency = {}
+        LLM_CONCURRENCY_LIMIT.set(self.limit)
+
+    @classmethod
+    def from_env(cls):
+        return cls(
+            requests_per_minute=float(os.getenv("TALKQL_LLM_RPM", 500)),
+            tokens_per_minute=float(os.getenv("TALKQL_LLM_TPM", 200_000)),
+            max_concurrency=int(os.getenv("TALKQL_LLM_MAX_CONCURRENCY", 64)),
+            max_retries=int(os.getenv("TALKQL_LLM_MAX_RETRIES", 5)),
+        )
+
+    def invoke(self, runnable, prompt, priority: str = None):
+        """Invoke a model (or any runnable) on a prompt under admission control"""
+        tokens = estimate_tokens(prompt) + self.expected_completion_tokens
+        return self.call(lambda: runnable.invoke(prompt), tokens, priority, model_of(runnable))
+
+    def call(self, fn, tokens: int = 1, priority: str = None, model: str = "unknown"):
+        priority = priority or _priority.get()
+        for attempt in range(self.max_retries + 1):
+            self._acquire(priority, tokens)
+            start = time.monotonic()
+            try:
+                result = fn()
+            except Exception as e:
+                self._release()
+                if attempt == self.max_retries:
+                    raise
+                if is_rate_limit_error(e):
+                    delay = self._on_rate_limited(attempt, retry_after(e))
+                    logger.warning(f"LLM rate limited, retrying in {delay:.2f}s (attempt {attempt + 1})")
+                elif is_transient_error(e):
+                    # Only this call backs off; the quota isn't exhausted
+                    delay = retry_after(e) or min(8.0, 0.5 * 2 ** attempt) * (1 + random.random() * 0.2)
+                    logger.warning(f"LLM call failed with {type(e).__name__}, retrying in {delay:.2f}s "
+                                   f"(attempt {attempt + 1})")
+                else:
+                    raise
+                LLM_RETRIES.inc(priority=priority)
+                time.sleep(delay)
+                continue
+            self._release()
+            self._on_success(model, time.monotonic() - start)
+            return result
+
+    def _acquire(self, priority: str, tokens: int):
+        ticket = (PRIORITIES[priority], next(self._sequence))
+        queued_at = time.monotonic()
+        with self._cond:
+            heapq.heappush(self._queue, ticket)
+            while True:
+                wait = None
+                if self._queue[0] == ticket and self._active < int(self.limit):
+                    wait = max(self._paused_until - time.monotonic(),
+                               self.requests.wait_time(1), self.tokens.wait_time(tokens))
+                    if wait <= 0:
+                        heapq.heappop(self._queue)
+                        self.requests.take(1)
+                        self.tokens.take(tokens)
+                        self._active += 1
+                        LLM_IN_FLIGHT.set(self._active)
+                        # The next ticket in line may be admissible as well
+                        self._cond.notify_all()
+                        break
+                self._cond.wait(timeout=wait)
+        LLM_QUEUE_WAIT.observe(time.monotonic() - queued_at, priority=priority)
+
+    def _release(self):
+        with self._cond:
+            self._active -= 1
+            LLM_IN_FLIGHT.set(self._active)
+            self._cond.notify_all()
+
+    def _on_success(self, model: str, latency: float):
+        with self._cond:
+            averages = self._latency.setdefault(model, [latency, latency])
+            averages[0] += 0.3 * (latency - averages[0])
+            averages[1] += 0.02 * (latency - averages[1])
+            if averages[0] > self.latency_tolerance * averages[1]:
+                self.limit = max(self.min_concurrency, self.limit * 0.9)
+            else:
+                self.limit = min(self.max_concurrency, self.limit + 1 / self.limit)
+            LLM_CONCURRENCY_LIMIT.set(self.limit)
+            self._cond.notify_all()
+
+    def _on_rate_limited(self, attempt: int, retry_after_seconds: float = None) -> float:
+        LLM_RATE_LIMITED.inc()
+        delay = retry_after_seconds if retry_after_seconds is not None else min(30.0, 0.5 * 2 ** attempt)
+        delay *= 1 + random.random() * 0.2
+        with self._cond:
+            self.limit = max(self.min_concurrency, self.limit / 2)
+            self._paused_until = max(self._paused_until, time.monotonic() + delay)
+            LLM_CONCURRENCY_LIMIT.set(self.limit)
+        return delay
+
+
+LLM_LIMITER = LLMLimiter.from_env()
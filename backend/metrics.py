@@ -0,0 +1,318 @@
+"""
+Lightweight Prometheus-style metrics for the TalkQL backend.
+
+Metrics live in a process-wide registry and are rendered in the Prometheus
+text exposition format by the /metrics endpoint. Only the standard library is
+used so importing this module stays cheap.
+"""
+import functools
+import threading
+import time
+from contextlib import contextmanager
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+TOKEN_BUCKETS = (16, 64, 256, 1024, 2048, 4096, 8192, 16384, 32768, 65536, 131072)
+ROW_BUCKETS = (0, 1, 10, 100, 1000, 10000, 100000, 1000000)
+BYTE_BUCKETS = (1024, 10240, 102400, 524288, 1048576, 5242880, 10485760, 52428800)
+
+
+def _format_labels(label_names, label_values, extra=None):
+    pairs = list(zip(label_names, label_values))
+    if extra:
+        pairs.append(extra)
+    if not pairs:
+        return ""
+    escaped = (str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"') for _, value in pairs)
+    return "{" + ",".join(f'{name}="{value}"' for (name, _), value in zip(pairs, escaped)) + "}"
+
+
+class Metric:
+    kind = None
+
+    def __init__(self, name, description, labels=()):
+        self.name = name
+        self.description = description
+        self.label_names = tuple(labels)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def _key(self, labels):
+        if set(labels) != set(self.label_names):
+            raise ValueError(f"{self.name} expects labels {self.label_names}, got {tuple(labels)}")
+        return tuple(str(labels[name]) for name in self.label_names)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.description}", f"# TYPE {self.name} {self.kind}"]
+        with self._lock:
+            items = sorted(self._values.items())
+        for label_values, value in items:
+            lines.extend(self._render_value(label_values, value))
+        return lines
+
+    def _render_value(self, label_values, value):
+        return [f"{self.name}{_format_labels(self.label_names, label_values)} {value}"]
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels):
+        return self._values.get(self._key(labels), 0)
+
+
+class Gauge(Metric):
+    kind = "gauge"
+
+    def set(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+    def value(self, **labels):
+        return self._values.get(self._key(labels), 0)
+
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name, description, labels=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, description, labels)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            state = self._values.get(key)
+            if state is None:
+                state = self._values[key] = {"buckets": [0] * len(self.buckets), "sum": 0.0, "count": 0}
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    state["buckets"][i] += 1
+            state["sum"] += value
+            state["count"] += 1
+
+    @contextmanager
+    def time(self, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def snapshot(self, **labels):
+        """Return (count, sum) for one label set, mainly for benchmarks"""
+        state = self._values.get(self._key(labels))
+        return (state["count"], state["sum"]) if state else (0, 0.0)
+
+    def _render_value(self, label_values, state):
+        lines = []
+        for bound, count in zip(self.buckets, state["buckets"]):
+            labels = _format_labels(self.label_names, label_values, ("le", bound))
+            lines.append(f"{self.name}_bucket{labels} {count}")
+        labels = _format_labels(self.label_names, label_values, ("le", "+Inf"))
+        lines.append(f"{self.name}_bucket{labels} {state['count']}")
+        labels = _format_labels(self.label_names, label_values)
+        lines.append(f"{self.name}_sum{labels} {state['sum']}")
+        lines.append(f"{self.name}_count{labels} {state['count']}")
+        return lines
+
+
+class Registry:
+    def __init__(self):
+        self._metrics = {}
+        self._lock = threading.Lock()
+
+    def register(self, metric):
+        with self._lock:
+            existing = self._metrics.get(metric.name)
+            if existing is not None:
+                return existing
+            self._metrics[metric.name] = metric
+            return metric
+
+    def render(self):
+        with self._lock:
+            metrics = list(self._metrics.values())
+        lines = []
+        for metric in metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+    def reset(self):
+        """Clear every recorded value while keeping the metric definitions"""
+        with self._lock:
+            for metric in self._metrics.values():
+                with metric._lock:
+                    metric._values.clear()
+
+
+REGISTRY = Registry()
+
+
+def counter(name, description, labels=()):
+    return REGISTRY.register(Counter(name, description, labels))
+
+
+def gauge(name, description, labels=()):
+    return REGISTRY.register(Gauge(name, description, labels))
+
+
+def histogram(name, description, labels=(), buckets=LATENCY_BUCKETS):
+    return REGISTRY.register(Histogram(name, description, labels, buckets))
+
+
+NODE_DURATION = histogram(
+    "talkql_node_duration_seconds", "Wall time of each agent graph node", ["agent", "node"])
+STAGE_DURATION = histogram(
+    "talkql_stage_duration_seconds", "Wall time of each stage of an API request", ["stage"])
+LLM_DURATION = histogram(
+    "talkql_llm_duration_seconds", "Latency of a single LLM call", ["model"])
+LLM_TOKENS = histogram(
+    "talkql_llm_tokens", "Tokens used by a single LLM call (prompt, completion, and cached: prompt tokens read from "
+    "the provider's prefix cache)", ["model", "kind"], TOKEN_BUCKETS)
+LLM_ERRORS = counter(
+    "talkql_llm_errors_total", "LLM calls that raised an error", ["model"])
+DB_QUERY_DURATION = histogram(
+    "talkql_db_query_duration_seconds", "Execution time of SQL queries against the connected database", ["dialect"])
+DB_ROWS = histogram(
+    "talkql_db_rows_returned", "Rows returned by SQL queries against the connected database", ["dialect"], ROW_BUCKETS)
+VIZ_RENDER_DURATION = histogram(
+    "talkql_viz_render_duration_seconds", "Time to execute the plotting code and encode the image")
+VIZ_PAYLOAD_BYTES = histogram(
+    "talkql_viz_payload_bytes", "Size of the base64 image data URL returned to the client", (), BYTE_BUCKETS)
+MODEL_TIER_DURATION = histogram(
+    "talkql_model_tier_duration_seconds", "Latency of routed LLM calls per node and model tier", ["node", "tier"])
+MODEL_CALLS = counter(
+    "talkql_model_calls_total", "Routed LLM calls per node and model tier", ["node", "tier"])
+MODEL_ESCALATIONS = counter(
+    "talkql_model_escalations_total", "Cascade calls escalated from the small to the large model", ["node", "reason"])
+
+QUERY_EXECUTIONS = counter(
+    "talkql_query_executions_total", "Pipeline executions started for coalescable requests", ["endpoint"])
+QUERIES_COALESCED = counter(
+    "talkql_query_coalesced_total", "Requests that waited on an identical in-flight request instead of executing", ["endpoint"])
+
+LLM_QUEUE_WAIT = histogram(
+    "talkql_llm_queue_wait_seconds", "Time LLM calls waited for admission by the limiter", ["priority"])
+LLM_CONCURRENCY_LIMIT = gauge(
+    "talkql_llm_concurrency_limit", "Current adaptive limit on concurrent LLM calls")
+LLM_IN_FLIGHT = gauge(
+    "talkql_llm_in_flight", "LLM calls currently admitted by the limiter")
+LLM_RATE_LIMITED = counter(
+    "talkql_llm_rate_limited_total", "LLM calls rejected by the provider with a rate-limit error")
+LLM_RETRIES = counter(
+    "talkql_llm_retries_total", "LLM calls retried by the limiter after a rate-limit or transient error", ["priority"])
+
+INGEST_FILE_DURATION = histogram(
+    "talkql_ingest_file_duration_seconds", "Time to parse and load one uploaded file into its table", ["format"])
+INGEST_BYTES = counter(
+    "talkql_ingest_bytes_total", "Bytes of uploaded files loaded into tables", ["format"])
+CSV_REFRESHES = counter(
+    "talkql_csv_refreshes_total", "CSV reloads by how the table was brought up to date", ["mode"])
+DOWNLOADS = counter(
+    "talkql_downloads_total", "Remote database and CSV fetches by how they were served", ["result"])
+DOWNLOAD_BYTES = counter(
+    "talkql_download_bytes_total", "Bytes transferred when downloading remote databases and CSVs")
+
+DB_POOL_CHECKED_OUT = gauge(
+    "talkql_db_pool_checked_out", "Database connections currently checked out of the pool", ["dialect"])
+DB_POOL_OVERFLOW = gauge(
+    "talkql_db_pool_overflow", "Database connections open beyond the pool size", ["dialect"])
+DB_POOL_WAIT = histogram(
+    "talkql_db_pool_wait_seconds", "Time spent waiting to check a connection out of the pool", ["dialect"])
+DB_CONNECTIONS_OPENED = counter(
+    "talkql_db_connections_opened_total", "New database connections opened by the pool", ["dialect"])
+
+EXPORT_ROWS = counter(
+    "talkql_export_rows_total", "Rows streamed by result exports", ["format"])
+EXPORT_DURATION = histogram(
+    "talkql_export_duration_seconds", "Time to stream a full result export", ["format"])
+
+def timed_node(agent):
+    """Decorator recording the wall time of a graph node method"""
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(self, state):
+            start = time.perf_counter()
+            try:
+                return func(self, state)
+            finally:
+                NODE_DURATION.observe(time.perf_counter() - start, agent=agent, node=func.__name__)
+        return wrapper
+    return decorator
+
+
+_llm_callback_handler = None
+
+
+def llm_callback_handler():
+    """
+    Shared LangChain callback handler recording LLM latency and token usage.
+    Defined lazily because langchain_core is too heavy to import with this module.
+    """
+    global _llm_callback_handler
+    if _llm_callback_handler is not None:
+        return _llm_callback_handler
+
+    from langchain_core.callbacks import BaseCallbackHandler
+
+    class MetricsCallbackHandler(BaseCallbackHandler):
+        def __init__(self):
+            self._runs = {}
+
+        def on_chat_model_start(self, serialized, messages, *, run_id, **kwargs):
+            self._start(serialized, run_id, kwargs)
+
+        def on_llm_start(self, serialized, prompts, *, run_id, **kwargs):
+            self._start(serialized, run_id, kwargs)
+
+        def _start(self, serialized, run_id, kwargs):
+            params = kwargs.get("invocation_params") or {}
+            model = params.get("model_name") or params.get("model") or (serialized or {}).get("name", "unknown")
+            self._runs[run_id] = (model, time.perf_counter())
+
+        def on_llm_end(self, response, *, run_id, **kwargs):
+            model, start = self._runs.pop(run_id, ("unknown", None))
+            if start is not None:
+                LLM_DURATION.observe(time.perf_counter() - start, model=model)
+            for kind, tokens in token_usage(response).items():
+                LLM_TOKENS.observe(tokens, model=model, kind=kind)
+
+        def on_llm_error(self, error, *, run_id, **kwargs):
+            model, _ = self._runs.pop(run_id, ("unknown", None))
+            LLM_ERRORS.inc(model=model)
+
+    _llm_callback_handler = MetricsCallbackHandler()
+    return _llm_callback_handler
+
+
+def token_usage(response):
+    """Extract prompt, completion and cached prompt token counts from an LLMResult"""
+    for generations in response.generations:
+        for generation in generations:
+            usage = getattr(getattr(generation, "message", None), "usage_metadata", None)
+            if usage:
+                return {"prompt": usage.get("input_tokens", 0), "completion": usage.get("output_tokens", 0),
+                        "cached": (usage.get("input_token_details") or {}).get("cache_read", 0)}
+    usage = (response.llm_output or {}).get("token_usage") or {}
+    if usage:
+        return {"prompt": usage.get("prompt_tokens", 0), "completion": usage.get("completion_tokens", 0),
+                "cached": (usage.get("prompt_tokens_details") or {}).get("cached_tokens", 0)}
+    return {}
+
+
+def render():
+    return REGISTRY.render()
@@ -0,0 +1,138 @@
+"""
+Per-node model routing for the agents.
+
+Each graph node is routed to a model tier:
+- "small": the cheap model only
+- "large": the strong model only
+- "cascade": the small model first, escalating to the large model when the
+  question looks complex, the call fails, or its output fails local validation
+
+Routes can be overridden with the TALKQL_MODEL_ROUTES environment variable, e.g.
+TALKQL_MODEL_ROUTES='{"generate_query": "large"}', and the tier models with
+TALKQL_SMALL_MODEL / TALKQL_LARGE_MODEL.
+"""
+import json
+import logging
+import os
+import re
+import threading
+
+from llm_limiter import LLM_LIMITER
+from metrics import llm_callback_handler, MODEL_TIER_DURATION, MODEL_CALLS, MODEL_ESCALATIONS
+
+logger = logging.getLogger(__name__)
+
+TIER_MODELS = {
+    "small": os.getenv("TALKQL_SMALL_MODEL", "gpt-4o-mini"),
+    "large": os.getenv("TALKQL_LARGE_MODEL", "gpt-4o"),
+}
+
+DEFAULT_ROUTES = {
+    "generate_query": "cascade",
+    "correct_and_optimize_query": "cascade",
+    "submit_final_answer": "small",
+}
+
+# Phrases that usually need multi-step reasoning or several joins
+COMPLEX_QUESTION_PATTERNS = [
+    r"\bvs\.?\b", r"\bversus\b", r"\bcompar", r"\bgrowth\b", r"\bover time\b",
+    r"\byear[- ]over[- ]year\b", r"\bmonth[- ]over[- ]month\b", r"\bcumulative\b", r"\brunning total\b",
+    r"\brank", r"\bpercentile\b", r"\bpercentage\b", r"\bratio\b", r"\bshare of\b", r"\bcorrelat",
+]
+
+MAX_MENTIONED_TABLES = 2
+
+
+def question_complexity(question: str, table_names=()):
+    """Return why a question needs the large model, or None if the small model should do"""
+    text = question.lower()
+    for pattern in COMPLEX_QUESTION_PATTERNS:
+        if re.search(pattern, text):
+            return "complex_question"
+    mentioned = [name for name in table_names if re.search(rf"\b{re.escape(name.lower())}", text)]
+    if len(mentioned) > MAX_MENTIONED_TABLES:
+        return "many_tables"
+    return None
+
+
+def load_routes():
+    routes = dict(DEFAULT_ROUTES)
+    override = os.getenv("TALKQL_MODEL_ROUTES")
+    if override:
+        routes.update(json.loads(override))
+    return routes
+
+
+class ModelRouter:
+    def __init__(self, routes=None, llm=None, llms=None):
+        """
+        Args:
+            routes: node name -> "small" | "large" | "cascade"; unlisted nodes use "large"
+            llm: a single model used for every tier (mainly for tests and benchmarks)
+            llms: tier -> model instance, overriding the OpenAI defaults
+        """
+        self.routes = routes if routes is not None else load_routes()
+        self._llms = dict(llms or {})
+        if llm is not None:
+            self._llms.setdefault("small", llm)
+            self._llms.setdefault("large", llm)
+        self._lock = threading.Lock()
+
+    def get_llm(self, tier: str):
+        if tier not in self._llms:
+            with self._lock:
+                if tier not in self._llms:
+                    from langchain_openai import ChatOpenAI
+                    # Retries are owned by the limiter: it backs off for every caller at once on 429s
+                    # and retries server errors, timeouts and connection errors per call
+                    self._llms[tier] = ChatOpenAI(
+                        model=TIER_MODELS[tier], temperature=0, max_retries=0,
+                        callbacks=[llm_callback_handler()])
+        return self._llms[tier]
+
+    def route(self, node: str):
+        return self.routes.get(node, "large")
+
+    def invoke(self, node: str, schema, prompt, validate=None, complexity=None, tools=None):
+        """
+        Run a structured-output call for a node on the tier its route selects.
+
+        Args:
+            tools: every schema to bind, in a fixed order shared by the nodes that use it, with
+                `schema` forced through tool_choice. Tool definitions precede the messages in
+                the provider's prompt, so nodes binding the same list share a cacheable prefix
+            validate: called with the small model's result; returns a reason string to escalate or None
+            complexity: reason the request is known to be complex up front, which skips the small model
+        """
+        route = self.route(node)
+        if route != "cascade":
+            return self._call(node, route, schema, prompt, tools)
+
+        if complexity:
+            MODEL_ESCALATIONS.inc(node=node, reason=complexity)
+            return self._call(node, "large", schema, prompt, tools)
+
+        try:
+            result = self._call(node, "small", schema, prompt, tools)
+            reason = validate(result) if validate else None
+        except Exception as e:
+            logger.warning(f"Small model failed for {node}, escalating: {str(e)}")
+            reason = "error"
+        if reason is None:
+            return result
+        logger.info(f"Escalating {node} to the large model: {reason}")
+        MODEL_ESCALATIONS.inc(node=node, reason=reason)
+        return self._call(node, "large", schema, prompt, tools)
+
+    def _call(self, node: str, tier: str, schema, prompt, tools=None):
+        if tools:
+            from langchain_core.output_parsers.openai_tools import PydanticToolsParser
+
+            # What with_structured_output binds, but with the whole shared tool list
+            llm = self.get_llm(tier).bind_tools(tools, tool_choice=schema.__name__, parallel_tool_calls=False)
+            runnable = llm | PydanticToolsParser(tools=[schema], first_tool_only=True)
+        else:
+            runnable = self.get_llm(tier).with_structured_output(schema)
+        MODEL_CALLS.inc(node=node, tier=tier)
+        with MODEL_TIER_DURATION.time(node=node, tier=tier):
+            return LLM_LIMITER.invoke(runnable, prompt)
@@ -0,0 +1,248 @@
+"""
+Compact column profiles that describe a table's data in the schema prompt.
+
+Instead of a few raw sample rows, every column gets its distinct count, null
+fraction, value range for numbers and dates, and the most common values of
+low-cardinality text columns, or all values of a small categorical column of
+unique values such as genre names. That is fewer tokens and tells the model
+which filter values actually exist.
+
+Tables are profiled with SQL after connecting, except CSV uploads: their
+chunks are summarised while they are loaded (`chunk_stats`), and the summaries
+are merged (`merge_stats`) and kept with the table so an append only has to
+summarise the new rows.
+
+A profile is a plain dict:
+    {"rows": 412, "sampled": False, "columns": [{"name": ..., "kind": ..., "distinct": ...,
+     "null_fraction": ..., "min": ..., "max": ..., "top": [(value, count), ...]}]}
+"""
+import datetime
+import decimal
+import re
+
+# Profile at most this many rows of a table so connecting to huge tables stays cheap
+PROFILE_ROW_LIMIT = 100_000
+# Text columns with at most this many distinct values get their most common values listed
+LOW_CARDINALITY = 100
+TOP_K = 5
+# Columns of unique values are listed in full only up to this many; beyond it they are names,
+# emails and the like, and "most common" means nothing when every value occurs once
+CATEGORICAL_VALUES = 20
+MAX_VALUE_LENGTH = 40
+# Distinct counts above LOW_CARDINALITY are estimated from this many smallest value hashes
+SKETCH_SIZE = 256
+
+# Dates stored as text, as SQLite and CSV files do
+ISO_DATE = re.compile(r"\d{4}-\d{2}-\d{2}([ T]\d{2}:\d{2}(:\d{2}(\.\d+)?)?)?$")
+
+
+def lists_values(distinct, non_null):
+    """Worth listing: a low-cardinality column whose values repeat, or a small categorical one"""
+    if distinct == non_null:
+        return 0 < distinct <= CATEGORICAL_VALUES
+    return 0 < distinct <= LOW_CARDINALITY
+
+
+def listed_count(distinct, non_null):
+    """All values of a column of unique values, since none is more common than another; else the top few"""
+    return distinct if distinct == non_null else TOP_K
+
+
+def column_kind(python_type):
+    if python_type is bool:
+        return "bool"
+    if python_type in (int, float, decimal.Decimal):
+        return "number"
+    if python_type in (datetime.date, datetime.datetime, datetime.time):
+        return "date"
+    if python_type is str:
+        return "text"
+    return None
+
+
+def text_date_range(minimum, maximum):
+    """The range of a text column if both ends are ISO dates, otherwise None"""
+    if isinstance(minimum, str) and isinstance(maximum, str) and ISO_DATE.match(minimum) and ISO_DATE.match(maximum):
+        return minimum, maximum
+    return None
+
+
+def sql_column_kind(column):
+    try:
+        return column_kind(column.type.python_type)
+    except NotImplementedError:
+        return None
+
+
+def profile_table(engine, table):
+    """Profile a reflected SQLAlchemy table with one aggregate query plus one per listed column"""
+    from sqlalchemy import func, select
+
+    columns = [(column, sql_column_kind(column)) for column in table.columns]
+    columns = [(column, kind) for column, kind in columns if kind]
+    sample = select(*[column for column, _ in columns]).limit(PROFILE_ROW_LIMIT).subquery()
+
+    aggregates = [func.count()]
+    for column, kind in columns:
+        sampled = sample.c[column.name]
+        aggregates += [func.count(sampled), func.count(sampled.distinct())]
+        aggregates += [func.min(sampled), func.max(sampled)]
+
+    with engine.connect() as connection:
+        values = iter(connection.execute(select(*aggregates).select_from(sample)).one())
+        rows = next(values)
+        profiles = []
+        for column, kind in columns:
+            non_null, distinct = next(values), next(values)
+            profile = {"name": column.name, "kind": kind, "distinct": distinct,
+                       "null_fraction": 1 - non_null / rows if rows else 0.0}
+            minimum, maximum = next(values), next(values)
+            if kind in ("number", "date"):
+                profile["min"], profile["max"] = minimum, maximum
+            elif kind == "text" and text_date_range(minimum, maximum):
+                profile["kind"], profile["min"], profile["max"] = "date", minimum, maximum
+            if kind in ("text", "bool") and lists_values(distinct, non_null):
+                sampled = sample.c[column.name]
+                count = func.count().label("count")
+                top = select(sampled, count).where(sampled.is_not(None)).group_by(sampled)
+                profile["top"] = [tuple(row) for row in connection.execute(
+                    top.order_by(count.desc(), sampled).limit(listed_count(distinct, non_null)))]
+            profiles.append(profile)
+    return {"rows": rows, "sampled": rows >= PROFILE_ROW_LIMIT, "columns": profiles}
+
+
+def _scalar(value):
+    return value.item() if hasattr(value, "item") else value
+
+
+def chunk_stats(df):
+    """
+    Mergeable statistics of a DataFrame chunk, e.g. while it is being loaded from a CSV.
+    Plain JSON-serializable values, so they can be stored with the table.
+    """
+    import numpy as np
+    import pandas as pd
+
+    columns = []
+    for name in df.columns:
+        series = df[name]
+        if pd.api.types.is_bool_dtype(series):
+            kind = "bool"
+        elif pd.api.types.is_numeric_dtype(series):
+            kind = "number"
+        elif pd.api.types.is_datetime64_any_dtype(series):
+            kind = "date"
+        elif pd.api.types.is_object_dtype(series) or pd.api.types.is_string_dtype(series):
+            kind = "text"
+        else:
+            kind = None
+        values = series.dropna()
+        stats = {"name": str(name), "kind": kind, "non_null": len(values), "min": None, "max": None,
+                 "counts": None, "sketch": [], "repeats": False}
+        if kind and len(values):
+            if kind == "text":
+                values = values.astype(str)
+            if kind != "bool":
+                stats["min"], stats["max"] = _scalar(values.min()), _scalar(values.max())
+            if kind in ("text", "bool"):
+                counts = values.value_counts()
+                if len(counts) <= LOW_CARDINALITY:
+                    stats["counts"] = [[_scalar(value), int(count)] for value, count in counts.items()]
+            # Hashes are deterministic across processes, unlike hash()
+            hashes = np.unique(pd.util.hash_pandas_object(values, index=False).to_numpy())
+            stats["sketch"] = [int(value) for value in hashes[:SKETCH_SIZE]]
+            stats["repeats"] = len(hashes) < len(values)
+        columns.append(stats)
+    return {"rows": len(df), "columns": columns}
+
+
+def merge_stats(first, second):
+    """Statistics of the rows of both; either may be None"""
+    if first is None or second is None:
+        return first or second
+    columns = []
+    for a, b in zip(first["columns"], second["columns"]):
+        # A chunk where a column is all empty has no say in its kind
+        sides = [stats for stats in (a, b) if stats["non_null"]] or [a]
+        kind = sides[0]["kind"] if all(stats["kind"] == sides[0]["kind"] for stats in sides) else "text"
+        merged = {"name": a["name"], "kind": kind, "non_null": a["non_null"] + b["non_null"],
+                  "min": None, "max": None, "counts": None,
+                  "sketch": sorted(set(a["sketch"]) | set(b["sketch"]))[:SKETCH_SIZE],
+                  # A hash kept by both sketches is a value found in both
+                  "repeats": a["repeats"] or b["repeats"] or bool(set(a["sketch"]) & set(b["sketch"]))}
+        # Chunks parsed as different kinds can't be compared, so they keep neither range nor counts
+        if all(stats["kind"] == kind for stats in sides):
+            ends = [stats for stats in sides if stats["min"] is not None]
+            if ends:
+                merged["min"], merged["max"] = min(s["min"] for s in ends), max(s["max"] for s in ends)
+            if all(stats["counts"] is not None for stats in sides):
+                counts = {}
+                for stats in sides:
+                    for value, count in stats["counts"]:
+                        counts[value] = counts.get(value, 0) + count
+                if len(counts) <= LOW_CARDINALITY:
+                    merged["counts"] = [[value, count] for value, count in counts.items()]
+        columns.append(merged)
+    return {"rows": first["rows"] + second["rows"], "columns": columns}
+
+
+def stats_profile(stats):
+    """The profile of statistics gathered with chunk_stats and merge_stats"""
+    profiles = []
+    for column in stats["columns"]:
+        if column["kind"] is None:
+            continue
+        sketch, non_null = column["sketch"], column["non_null"]
+        if column["counts"] is not None:
+            distinct = len(column["counts"])
+        elif len(sketch) < SKETCH_SIZE:
+            distinct = len(sketch)
+        else:
+            # k-minimum-values estimate: the k-th smallest of n uniform hashes is about k / n of the range
+            distinct = min(non_null, round((SKETCH_SIZE - 1) * 2 ** 64 / (sketch[-1] + 1)))
+            if not column["repeats"] and distinct > 0.8 * non_null:
+                # No value was seen twice and the estimate is within its error of all unique
+                distinct = non_null
+        profile = {"name": column["name"], "kind": column["kind"], "distinct": distinct,
+                   "null_fraction": 1 - non_null / stats["rows"] if stats["rows"] else 0.0}
+        if column["kind"] in ("number", "date"):
+            profile["min"], profile["max"] = column["min"], column["max"]
+        elif column["kind"] == "text" and text_date_range(column["min"], column["max"]):
+            profile["kind"], profile["min"], profile["max"] = "date", column["min"], column["max"]
+        if column["kind"] in ("text", "bool") and column["counts"] is not None and lists_values(distinct, non_null):
+            top = sorted(column["counts"], key=lambda item: (-item[1], str(item[0])))
+            profile["top"] = [tuple(item) for item in top[:listed_count(distinct, non_null)]]
+        profiles.append(profile)
+    return {"rows": stats["rows"], "sampled": False, "columns": profiles}
+
+
+def _format_value(value):
+    if hasattr(value, "item"):
+        # numpy scalars
+        value = value.item()
+    if isinstance(value, (float, decimal.Decimal)):
+        return f"{value:.3g}"
+    text = str(value)
+    if isinstance(value, datetime.datetime) and value.time() == datetime.time():
+        text = str(value.date())
+    if len(text) > MAX_VALUE_LENGTH:
+        text = text[:MAX_VALUE_LENGTH] + "..."
+    return f"'{text}'" if isinstance(value, str) else text
+
+
+def format_profile(profile):
+    """Render a profile as the comment block appended to a table's CREATE TABLE; kept terse to save tokens"""
+    scope = f"first {profile['rows']} rows" if profile["sampled"] else f"{profile['rows']} rows"
+    lines = [f"Column profile ({scope}):"]
+    for column in profile["columns"]:
+        non_null = round(profile["rows"] * (1 - column["null_fraction"]))
+        parts = ["unique" if column["distinct"] == non_null > 1 else f"{column['distinct']} distinct"]
+        if column["null_fraction"]:
+            parts.append(f"{column['null_fraction']:.0%} null")
+        if column.get("min") is not None:
+            parts.append(f"{_format_value(column['min'])} to {_format_value(column['max'])}")
+        if column.get("top"):
+            label = "values" if column["distinct"] <= len(column["top"]) else "most common"
+            parts.append(f"{label} " + ", ".join(_format_value(value) for value, _ in column["top"]))
+        lines.append(f"{column['name']}: {'; '.join(parts)}")
+    return "\n".join(lines)
@@ -0,0 +1,47 @@
+import asyncio
+import re
+
+from metrics import QUERIES_COALESCED, QUERY_EXECUTIONS
+
+
+def normalize_question(question: str) -> str:
+    """Case, whitespace and trailing punctuation don't change what is being asked"""
+    return re.sub(r"\s+", " ", question).strip().rstrip("?.! ").lower()
+
+
+class SingleFlight:
+    """
+    Coalesce concurrent calls with the same key into a single execution.
+
+    The first caller for a key starts the coroutine in a task; callers arriving while
+    it is still in flight wait for it and receive the same result (or exception).
+    Cancelling any caller, the first included, only stops that caller waiting.
+    Nothing is cached once the call completes.
+    """
+
+    def __init__(self, name: str):
+        self.name = name
+        self._calls = {}
+
+    async def do(self, key, fn, *args):
+        task = self._calls.get(key)
+        if task is not None:
+            QUERIES_COALESCED.inc(endpoint=self.name)
+        else:
+            # The execution runs in its own task, so the caller that started it
+            # can disconnect without cancelling it for everyone else
+            task = asyncio.ensure_future(fn(*args))
+            self._calls[key] = task
+            task.add_done_callback(lambda done: self._finish(key, done))
+            QUERY_EXECUTIONS.inc(endpoint=self.name)
+        return await asyncio.shield(task)
+
+    def _finish(self, key, task):
+        if self._calls.get(key) is task:
+            del self._calls[key]
+        if not task.cancelled():
+            # Mark the exception as retrieved in case every caller went away
+            task.exception()
+
+    def in_flight(self) -> int:
+        return len(self._calls)
@@ -1,31 +1,70 @@
 import os
 from dotenv import load_dotenv
-from langchain_openai import ChatOpenAI
-import requests
-from langchain_community.agent_toolkits import SQLDatabaseToolkit
 from langchain_core.tools import Tool
-from langchain_core.prompts import ChatPromptTemplate
-from typing import Annotated
-from langchain_core.messages import AIMessage, HumanMessage 
-from langchain_openai import ChatOpenAI
+from langchain_core.prompt_values import ChatPromptValue
+from typing import Annotated, Optional
+from langchain_core.messages import AIMessage, HumanMessage, RemoveMessage, SystemMessage
 from pydantic import BaseModel, Field
 from typing_extensions import TypedDict
 from langgraph.graph import END, StateGraph, START
 from langgraph.graph.message import AnyMessage, add_messages
-from langchain_community.utilities import SQLDatabase
-import pandas as pd
-import sqlite3
-import tempfile
+from conversation_store import ConversationStore
+from sql_rewrite import sample_query, approximation_note
+from profiling import profile_table, format_profile
+from ingestion import ingest_files, is_multi_file_source
+from csv_refresh import load_csv, STATE_TABLE as CSV_STATE_TABLE
+from download_cache import DownloadCache
+from engine_manager import ENGINES
+from model_router import ModelRouter, question_complexity
+from metrics import timed_node, DB_QUERY_DURATION, DB_ROWS
+import hashlib
+import itertools
+import logging
+import re
+import threading
+import time
 
 
 load_dotenv()
 openai_api_key = os.getenv("OPENAI_API_KEY")
+logger = logging.getLogger(__name__)
+
+# Same truncation langchain's SQLDatabase.run applies to every value
+MAX_STRING_LENGTH = 300
+# Generated SQL with more joins than this is sent to the large model
+MAX_SMALL_MODEL_JOINS = 3
+# Uploaded CSV files are loaded into this SQLite database
+CSV_DATABASE = "csv_database.db"
+CSV_DATABASE_URI = f"sqlite:///{CSV_DATABASE}"
+
+# Shared by every LLM node and every request on a connection, and kept byte-identical so the
+# provider's prompt prefix cache can reuse it; anything that varies goes after it
+SYSTEM_PROMPT = """You are a SQL expert answering questions about a {dialect} database.
+
+Tables: {tables}
+
+Schema of every table, each CREATE TABLE statement followed by a profile of its columns:
+
+{schema}
+
+The conversation that follows holds the user's questions and, for each one, the SQL query generated for it,
+the corrected query, the results of running it and the answer given. The last question may be a follow-up to
+earlier ones. The final message describes your task for the last question."""
 
 class Tables(BaseModel):
     tables: list[str] = Field(..., description="The list of tables")
 
 class State(TypedDict):
     messages: Annotated[list[AnyMessage], add_messages]
+    # Kept in the checkpoint so follow-up turns can skip table listing and schema retrieval
+    tables: str
+    table_schema: str
+    sql: str
+    # Set for approximate questions: the percentage of rows to sample, the SQL that ran on the
+    # sample (sql stays the exact query) and the note labelling the answer
+    sample_percent: Optional[float]
+    sampled_sql: Optional[str]
+    approximation: Optional[str]
 
 class DBQuery(BaseModel):
     query: str = Field(..., description="The SQL query to execute")
@@ -40,37 +79,98 @@ class SubmitFinalAnswer(BaseModel):
     """ Submit the final answer to the user based on the query result."""
     final_answer: str = Field(...,description = "The final answer to the user")
 
+# Bound in this order by every node, each forcing its own, so the tool definitions that
+# precede the messages don't break the prompt prefix shared across nodes
+NODE_TOOLS = [DBQuery, OptimizedQuery, SubmitFinalAnswer]
+
+def latest_question(messages):
+    """The most recent question asked by the user"""
+    for message in reversed(messages):
+        if isinstance(message, HumanMessage):
+            return message.content
+    return ""
+
 class SQLAgent:
-    def __init__(self):
-        self.llm = ChatOpenAI(model="gpt-4o", temperature = 0)
+    def __init__(self, llm=None, router=None, max_history_turns=5, max_conversations=500, conversation_ttl=1800,
+                 download_cache=None):
+        # Each node picks its model through the router; the OpenAI clients are created on first use
+        self.router = router or ModelRouter(llm=llm)
+        # Remote SQLite and CSV files are cached on disk so reconnects only revalidate them
+        self.downloads = download_cache or DownloadCache()
         self.db = None
+        self.engine = None
         self.list_tables_tool = None
         self.get_schema_tool = None
         self.db_query_tool = None
         self.query_check = None
         self.db_uri = None
+        # Caches that survive between queries for the current connection
+        self.tables_cache = None
+        self.schema_cache = {}
+        # Column profiles per table, computed once per connection and shown in place of sample rows
+        self.profiles = {}
+        # Per-file throughput and inferred relationships of the last multi-file upload
+        self.ingestion_report = None
+        # How the last single CSV upload was loaded: unchanged, appended to or rebuilt
+        self.refresh_report = None
+        self.app = None
+        # Conversation threads are checkpointed so follow-ups reuse the previous schema and SQL
+        self.max_history_turns = max_history_turns
+        self.conversations = ConversationStore(max_threads=max_conversations, idle_ttl=conversation_ttl)
+        self.conversation_app = None
+        self._lock = threading.RLock()
+        # Bumped on every reset so keys derived from the connection change even if the URI doesn't (CSV)
+        self._generations = itertools.count()
+        self._generation = next(self._generations)
 
+    @property
+    def llm(self):
+        return self.router.get_llm("large")
+
+    def reset(self):
+        """
+        Drop the current connection together with every cache built for it
+        """
+        with self._lock:
+            if self.db_uri:
+                # Close pooled connections instead of leaving them to the server's idle timeout
+                ENGINES.dispose(self.db_uri)
+            self.db = None
+            self.engine = None
+            self.db_uri = None
+            self.list_tables_tool = None
+            self.get_schema_tool = None
+            self.db_query_tool = None
+            self.tables_cache = None
+            self.schema_cache = {}
+            self.profiles = {}
+            self.ingestion_report = None
+            self.refresh_report = None
+            self.app = None
+            self.conversation_app = None
+            self.conversations.clear()
+            self._generation = next(self._generations)
 
-    
     def add_db(self, db_type: str, **connection_params):
         """
         Set up database connection based on the database type
         
         Args:
             db_type: Type of database (sqlite, mysql, postgresql, mssql, snowflake, csv)
-            connection_params: Database connection parameters
+            connection_params: Database connection parameters; for csv, file_path may also be
+                a directory or zip archive of CSV/Parquet files, loaded as one table per file.
+                A single CSV that was only appended to since it was last loaded has just its new
+                rows added unless refresh is "full".
         """
+        if db_type.lower() != "csv":
+            self.reset()
         if db_type.lower() == "sqlite":
             url = connection_params.get("url")
             db_name = "downloaded_database.db"
             if url:
-                response = requests.get(url)
-                if response.status_code == 200:
-                    with open(db_name, "wb") as f:
-                        f.write(response.content)
-                    self.db_uri = f"sqlite:///{db_name}"
-                else:
-                    raise Exception(f"Failed to download the database. Status code: {response.status_code}")
+                download = self.downloads.fetch(url)
+                # Opened read-only: the cached file is shared and stored under its content hash
+                self.db_uri = f"sqlite:///file:{os.path.abspath(download.path)}?mode=ro&uri=true"
             else:
                 db_path = connection_params.get("db_path", db_name)
                 self.db_uri = f"sqlite:///{db_path}"
@@ -128,46 +228,129 @@ class SQLAgent:
             delimiter = connection_params.get("delimiter", ",")
             
             try:
+                if file_path and is_multi_file_source(file_path):
+                    self.reset()
+                    # A directory or zip of CSV/Parquet files becomes one table per file
+                    self.ingestion_report = ingest_files(file_path, CSV_DATABASE, delimiter=delimiter)
+                    self.db_uri = CSV_DATABASE_URI
+                    return
                 if file_path:
-                    df = pd.read_csv(file_path, delimiter=delimiter)
+                    source = file_path
                 elif url:
                     # Add headers to ensure we get CSV content
                     headers = {
                         'User-Agent': 'Mozilla/5.0',
                         'Accept': 'text/csv,application/csv,text/plain'
                     }
-                    response = requests.get(url, headers=headers)
+                    download = self.downloads.fetch(url, headers=headers)
                     
-                    if 'text/html' in response.headers.get('content-type', '').lower():
+                    if 'text/html' in download.content_type.lower():
                         raise ValueError("URL returned HTML content instead of CSV data")
                     
-                    # Save content to temporary file
-                    with tempfile.NamedTemporaryFile(delete=False, suffix='.csv') as tmp:
-                        tmp.write(response.content)
-                        file_path = tmp.name
-                    
-                    df = pd.read_csv(file_path, delimiter=delimiter)
+                    source = download.path
                 else:
                     raise ValueError("Either file_path or url is required for CSV connection")
                 
-                # Create SQLite database from CSV
-                df.to_sql("csv_data", sqlite3.connect("csv_database.db"), 
-                         if_exists="replace", index=False)
-                self.db_uri = "sqlite:///csv_database.db"
+                # Create SQLite database from CSV, or add just the rows appended since it was loaded
+                connected = self.db_uri == CSV_DATABASE_URI and self.ingestion_report is None
+                refresh, profile = load_csv(source, CSV_DATABASE, "csv_data", delimiter=delimiter,
+                                            incremental=connection_params.get("refresh") != "full")
+                if connected and refresh["mode"] != "full":
+                    # Same table and columns: keep the connection and compiled graphs
+                    if refresh["mode"] == "append":
+                        self.invalidate_table("csv_data")
+                else:
+                    self.reset()
+                    self.db_uri = CSV_DATABASE_URI
+                if profile:
+                    # Profiled while loading, so it never has to be queried back
+                    self.profiles["csv_data"] = profile
+                self.refresh_report = refresh
                 
             except Exception as e:
+                self.reset()
                 raise ValueError(f"Failed to process CSV: {str(e)}")
         
         else:
             raise ValueError(f"Unsupported database type: {db_type}")
     
     
+    def invalidate_table(self, table: str):
+        """
+        Drop what was derived from a table's rows after they changed in place, keeping the
+        connection, the compiled graphs and everything derived from the table's columns
+        """
+        with self._lock:
+            self.profiles.pop(table, None)
+            self.schema_cache = {}
+            self._generation = next(self._generations)
+
     def get_db(self):
         if not self.db_uri:
             raise ValueError("Database URI not set. Please call add_db first.")
-        self.db = SQLDatabase.from_uri(self.db_uri)
+        from langchain_community.utilities import SQLDatabase
+        from sqlalchemy import inspect
+        self.engine = ENGINES.get(self.db_uri)
+        # The incremental CSV loader's bookkeeping is not part of the user's data
+        hidden = [CSV_STATE_TABLE] if self.db_uri == CSV_DATABASE_URI and inspect(self.engine).has_table(CSV_STATE_TABLE) else []
+        # Column profiles replace the sample rows in the schema
+        self.db = SQLDatabase(self.engine, sample_rows_in_table_info = 0, ignore_tables = hidden)
+
+    def warmup(self):
+        """
+        Open the connection, fill the table and schema caches and compile the graph
+        so that the first query after a connect or restart does not pay for it.
+        """
+        with self._lock:
+            if self.app is None:
+                if self.db is None:
+                    self.get_db()
+                self.define_tools()
+                self.tables_cache = self.list_tables_tool.invoke("")
+                self.app = self.build_graph()
+                self.conversation_app = self.build_graph(checkpointer=self.conversations)
+            if self.tables_cache not in self.schema_cache:
+                # Also rebuilds the schema of a table whose rows changed (invalidate_table)
+                self.schema_cache[self.tables_cache] = self.table_info(self.tables_cache)
+            return self.app
+
+    def table_info(self, table_names: str) -> str:
+        """
+        CREATE TABLE statements for a comma separated list of tables, each followed by its column profile
+        """
+        from sqlalchemy import MetaData, Table
+        from sqlalchemy.exc import SQLAlchemyError
+
+        tables = []
+        for name in sorted(name.strip() for name in table_names.split(",") if name.strip()):
+            info = self.db.get_table_info_no_throw([name])
+            if name not in self.profiles:
+                try:
+                    table = Table(name, MetaData(), autoload_with = self.engine)
+                    self.profiles[name] = profile_table(self.engine, table)
+                except SQLAlchemyError as e:
+                    logger.warning(f"Could not profile table {name}: {str(e)}")
+                    self.profiles[name] = None
+            if self.profiles[name]:
+                info = f"{info}\n\n/*\n{format_profile(self.profiles[name])}\n*/"
+            tables.append(info)
+        return "\n\n".join(tables)
+
+    @property
+    def connection_key(self):
+        """
+        Identifies the current connection without exposing the credentials in its URI
+        """
+        if not self.db_uri:
+            return None
+        return f"{self._generation}:{hashlib.sha256(self.db_uri.encode()).hexdigest()[:16]}"
+
+    @property
+    def is_ready(self):
+        return self.app is not None
     
     def define_tools(self):
+        from langchain_community.agent_toolkits import SQLDatabaseToolkit
 
         toolkit = SQLDatabaseToolkit(db = self.db, llm = self.llm)
         tools = toolkit.get_tools()
@@ -184,6 +367,50 @@ class SQLAgent:
             args_schema = DBQuery
         )
 
+    def run_sql(self, query: str):
+        """
+        Execute a SQL query and return the column names and all fetched rows,
+        recording the execution time and row count.
+        """
+        from sqlalchemy import text
+
+        dialect = self.engine.dialect.name
+        start = time.perf_counter()
+        try:
+            with self.engine.begin() as connection:
+                cursor = connection.execute(text(query))
+                columns = list(cursor.keys()) if cursor.returns_rows else []
+                rows = cursor.fetchall() if cursor.returns_rows else []
+        finally:
+            DB_QUERY_DURATION.observe(time.perf_counter() - start, dialect=dialect)
+        DB_ROWS.observe(len(rows), dialect=dialect)
+        return columns, rows
+
+    def validate_sql(self, query: str):
+        """
+        Cheap local checks on generated SQL. Returns the reason it should be
+        regenerated by a stronger model, or None when it looks fine.
+        """
+        from sqlalchemy import text
+        from sqlalchemy.exc import SQLAlchemyError
+
+        statement = re.sub(r"--[^\n]*|/\*.*?\*/", " ", query, flags = re.S).strip().rstrip(";")
+        if not re.match(r"(select|with)\b", statement, re.I):
+            return "not_a_select"
+        if len(re.findall(r"\bjoin\b", statement, re.I)) > MAX_SMALL_MODEL_JOINS:
+            return "many_joins"
+
+        # Ask the database to plan the query without running it
+        explain = {"sqlite": "EXPLAIN QUERY PLAN", "postgresql": "EXPLAIN", "mysql": "EXPLAIN",
+                   "snowflake": "EXPLAIN"}.get(self.engine.dialect.name)
+        if explain:
+            try:
+                with self.engine.connect() as connection:
+                    connection.execute(text(f"{explain} {statement}")).fetchall()
+            except SQLAlchemyError:
+                return "invalid_sql"
+        return None
+
     def db_query(self, query: str) -> str:
         """ 
         Execute the SQL query against the database and get back the result.
@@ -191,58 +418,64 @@ class SQLAgent:
         If error is returned, reqrite the query, check the query and try again.
         
         """
-        print("--------------------------------Executing db query tool--------------------------------")
-        print("--------------------------------")
-        print(query)
-        print("--------------------------------")
-        result = self.db.run_no_throw(query)
-        print("--------------------------------DB query tool executed--------------------------------")
-        # Format the result into a readable string
-        if isinstance(result, str):
-            return result
-        else:
-        # Convert the result to a formatted string
-            return result.to_string() if hasattr(result, 'to_string') else str(result)
+        from langchain_community.utilities.sql_database import truncate_word
+        from sqlalchemy.exc import SQLAlchemyError
+
+        logger.debug("Executing db query: %s", query)
+        try:
+            _, rows = self.run_sql(query)
+        except SQLAlchemyError as e:
+            return f"Error: {e}"
+        # Format the result the same way SQLDatabase.run does
+        if not rows:
+            return ""
+        return str([tuple(truncate_word(value, length=MAX_STRING_LENGTH) for value in row) for row in rows])
         
+    def prompt(self, state: State, task: str) -> ChatPromptValue:
+        """
+        The shared system prompt with the connection's tables and schema, then the
+        conversation, then the node's task, so only the end differs between calls
+        """
+        system = SYSTEM_PROMPT.format(dialect = self.engine.dialect.name, tables = state["tables"],
+                                      schema = state["table_schema"].strip())
+        return ChatPromptValue(messages = [SystemMessage(content = system), *state["messages"],
+                                           SystemMessage(content = task)])
+
+    @timed_node("sql_agent")
     def get_all_tables(self, state: State):
         """
         List all the tables in the database.
         """
-        messages = state["messages"]
-        print(f"Messages in get all tables: {messages}")
-        print("--------------------------------Getting all tables--------------------------------")
-        all_tables = self.list_tables_tool.invoke("")
-        print(all_tables)
-        print("--------------------------------All tables retrieved--------------------------------")
-        return {"messages": state["messages"] + [AIMessage(content = f"{all_tables}")]}
+        logger.debug("Messages in get all tables: %s", state["messages"])
+        if self.tables_cache is None:
+            self.tables_cache = self.list_tables_tool.invoke("")
+        all_tables = self.tables_cache
+        logger.debug("All tables: %s", all_tables)
+        return {"tables": all_tables}
     
+    @timed_node("sql_agent")
     def get_schema_for_all_tables(self, state: State):
         """
         Get the schema for all the tables
         """
-        print(f"Messages in get schema for all tables: {state['messages']}")
-        print("--------------------------------Getting schema for all tables--------------------------------")
-        print(state["messages"][-1].content)
-        relevant_tables_schema = self.get_schema_tool.invoke(state["messages"][-1].content)
-        print(relevant_tables_schema)
-        print("--------------------------------Schema for all tables retrieved--------------------------------")
-        return {"messages": state["messages"] + [AIMessage(content = f"{relevant_tables_schema}")]}
+        logger.debug("Messages in get schema for all tables: %s", state["messages"])
+        table_names = state["tables"]
+        if table_names not in self.schema_cache:
+            self.schema_cache[table_names] = self.table_info(table_names)
+        relevant_tables_schema = self.schema_cache[table_names]
+        logger.debug("Schema for tables %s: %s", table_names, relevant_tables_schema)
+        return {"table_schema": relevant_tables_schema}
     
+    @timed_node("sql_agent")
     def generate_query(self, state: State):
         """
         Generate a query based on the user's query and the schema of the tables
         """
         messages = state["messages"]
-        print(f"Messages in generate query: {messages}")
-        print("--------------------------------Generating query--------------------------------")
-        generate_query_system = """ 
-         You are a SQL expert that generates precise SQL queries based on user questions.
-            
-            You will be provided with state messages in placeholder which contains:
-            1. The user's question
-            2. All the tables in the database
-            3. The complete schema information for those tables
-            
+        logger.debug("Messages in generate query: %s", messages)
+        generate_query_task = """
+            Generate a SQL query that answers the last question.
+
             IMPORTANT STEPS:
             1. Analyze the provided schema information carefully
             2. Pay special attention to:
@@ -257,6 +490,8 @@ class SQLAgent:
             - If the user's question is about a specific value, include a filter for that value in the query
             - Uses proper aggregation functions when needed
             
+            If the last question is a follow-up, build on the previous SQL query instead of starting from scratch.
+            
             Remember to:
             - Always verify column names exist in the schema before using them
             - Use appropriate JOIN conditions based on the foreign key relationships
@@ -264,118 +499,108 @@ class SQLAgent:
             - Consider NULL handling where appropriate
             
             Return only the SQL query, nothing else.
-        
         """
-        generate_query_prompt = ChatPromptTemplate.from_messages([
-            ("system", generate_query_system),
-            ("placeholder", "{messages}")
-        ])
-        formatted_generate_query_prompt = generate_query_prompt.invoke({"messages":messages})  # Format the prompt
-        generate_query_llm = self.llm.with_structured_output(DBQuery)
-        generate_query_result = generate_query_llm.invoke(formatted_generate_query_prompt)
-        print("--------------------------------")
-        print(generate_query_result.query)
-        print("--------------------------------Query generated--------------------------------")
+        complexity = question_complexity(latest_question(messages), self.db.get_usable_table_names())
+        generate_query_result = self.router.invoke(
+            "generate_query", DBQuery, self.prompt(state, generate_query_task),
+            validate = lambda result: self.validate_sql(result.query), complexity = complexity, tools = NODE_TOOLS)
+        logger.debug("Generated query: %s", generate_query_result.query)
         return {"messages": state["messages"] + [AIMessage(content = f"{generate_query_result.query}")]}
 
+    @timed_node("sql_agent")
     def correct_and_optimize_query(self, state: State):
         """
         Correct and optimize the query
         """
         messages = state["messages"]
-        print(f"Messages in correct and optimize query: {messages}")
-        print("--------------------------------Correcting and optimizing query--------------------------------")
-        sql_query = messages[-1].content
-        correct_and_optimize_query_system = """
-        You are a SQL expert who corrects and optimizes SQL queries. 
-        Your job is to find any issues with the query and correct them.
+        logger.debug("Messages in correct and optimize query: %s", messages)
+        correct_and_optimize_query_task = """
+        The last message is the SQL query generated for the last question.
+        Find any issues with the query and correct them.
         You will also need to optimize the query for better performance. Try to make the query more efficient by reducing the number of joins, using appropriate indexes, and minimizing data retrieval. But make sure the results of the optimized query are still the same as the original query.
         If the user's question doesn't specify the number of results, restrict the number of results to top 10 using LIMIT 10 and mention that only top 10 results are shown in the comment.
-        
-        You will be provided with the state messages in placeholder which contains:
-        1. The user's question
-        2. All the tables in the database
-        3. The complete schema information for those tables
-        4. The SQL query that was generated
 
         Return only the SQL query with the comment, nothing else.
         """
 
-        correct_and_optimize_query_prompt = ChatPromptTemplate.from_messages([
-            ("system", correct_and_optimize_query_system),
-            ("placeholder", "{messages}")
-        ])
-        formatted_correct_and_optimize_query_prompt = correct_and_optimize_query_prompt.invoke({"messages":messages})  # Format the prompt
-        correct_and_optimize_query_llm = self.llm.with_structured_output(OptimizedQuery)
-        correct_and_optimize_query_result = correct_and_optimize_query_llm.invoke(formatted_correct_and_optimize_query_prompt)
-        print("--------------------------------Correct and optimize query result--------------------------------")
-        print(correct_and_optimize_query_result.query)
-        print("--------------------------------Query corrected and optimized--------------------------------")
+        correct_and_optimize_query_result = self.router.invoke(
+            "correct_and_optimize_query", OptimizedQuery, self.prompt(state, correct_and_optimize_query_task),
+            validate = lambda result: self.validate_sql(result.query), tools = NODE_TOOLS)
+        logger.debug("Corrected and optimized query: %s", correct_and_optimize_query_result.query)
         return {"messages": state["messages"] + [AIMessage(content = f"{correct_and_optimize_query_result.query}")]}
     
     
     
+    @timed_node("sql_agent")
     def execute_query(self, state: State):
         """
         Execute the query against the database
         """
-        
-        print("--------------------------------Executing query--------------------------------")
-        execute_query_system = """ 
-        You are a helpful assistant who is a SQL expert that executes SQL queries against the database.
-        
-        You will be given the SQL query to execute and its results.
-        Analyze the results and provide a clear, human-readable response.
-        Include both the final answer and the query used in your response.
-        """
-        
         sql_query = state["messages"][-1].content
-        print("--------------------------------")
-        print(f"Executing query: \n")
-        print(sql_query)
-        print("--------------------------------")
+        sampled_sql, approximation = None, None
+        if state.get("sample_percent"):
+            sample = sample_query(sql_query, self.engine.dialect.name, state["sample_percent"])
+            # Fall back to the exact query when it can't be sampled or the rewrite doesn't plan
+            if sample is not None and self.validate_sql(sample.sql) is None:
+                sampled_sql = sample.sql
+                approximation = approximation_note(sample)
+            else:
+                logger.info("Query is not eligible for sampling, running it exactly")
+        logger.debug("Executing query: %s", sampled_sql or sql_query)
 
         # Execute the query and get results
-        results = self.db_query_tool.invoke({"query": sql_query})
-        print(results)
-        print("--------------------------------Query executed--------------------------------")
-        return {"messages": state["messages"] + [AIMessage(content = f"{results}")]}
+        results = self.db_query_tool.invoke({"query": sampled_sql or sql_query})
+        logger.debug("Query results: %s", results)
+        return {"messages": state["messages"] + [AIMessage(content = f"{results}")], "sql": sql_query,
+                "sampled_sql": sampled_sql,
+                "approximation": approximation}
     
+    @timed_node("sql_agent")
     def submit_final_answer(self, state: State):
         """
         Submit the final answer to the user
         """
-        submit_final_answer_system = """You are a helpful assistant who can clearly and concisely format the results of a SQL query into a human-readable answer.
-        The state messages in placeholder contains:
-                1. The user's query
-                2. The SQL query that was used to generate the results
-                3. The results of the SQL query
-                4. Additional comment regarding the query results
+        submit_final_answer_task = """
+        The last messages are the SQL query used for the last question, with its comment, and its results.
+        Clearly and concisely format the results into a human-readable answer to the question.
         
-        Only if the query contains 'Provide result in tabular format', format the results in tabular format.
+        Only if the question contains 'Provide result in tabular format', format the results in tabular format.
         Otherwise, format the results clearly using regular text formatting and concisely to minimize any amount of whitespace.
         Use proper markdown, highlighting and formatting to make the results more readable, informative and intuitive.
         """
 
-
-        submit_final_answer_prompt = ChatPromptTemplate.from_messages([
-            ("system", submit_final_answer_system),
-            ("placeholder", "{messages}")
-        ])
-        messages = state["messages"]    
-        formatted_submit_final_answer_prompt = submit_final_answer_prompt.invoke({"messages":messages})  # Format the prompt
-        submit_final_answer_llm = self.llm.with_structured_output(SubmitFinalAnswer)
-        submit_final_answer_result = submit_final_answer_llm.invoke(formatted_submit_final_answer_prompt)
-        print(submit_final_answer_result.final_answer)
-        print("--------------------------------Final answer submitted--------------------------------")
-        return {"messages": state["messages"] + [AIMessage(content = f"{submit_final_answer_result.final_answer}")]}
+        submit_final_answer_result = self.router.invoke(
+            "submit_final_answer", SubmitFinalAnswer, self.prompt(state, submit_final_answer_task), tools = NODE_TOOLS)
+        final_answer = submit_final_answer_result.final_answer
+        if state.get("approximation"):
+            final_answer = f"{final_answer}\n\n{state['approximation']}"
+        logger.debug("Final answer: %s", final_answer)
+        return {"messages": state["messages"] + [AIMessage(content = f"{final_answer}")]}
     
-    def graph_workflow(self, user_query: str):
-        self.get_db()
-        self.define_tools()
-        
+    def route_turn(self, state: State):
+        """
+        Follow-up turns of a conversation already have the schema, so go straight to query generation
+        """
+        if state.get("table_schema"):
+            return "trim_history"
+        return "get_all_tables"
+
+    @timed_node("sql_agent")
+    def trim_history(self, state: State):
+        """
+        Bound the conversation to its most recent turns
+        """
+        messages = state["messages"]
+        turn_starts = [i for i, message in enumerate(messages) if isinstance(message, HumanMessage)]
+        # The tables and schema are kept in the state, so whole turns can be dropped
+        if len(turn_starts) - 1 <= self.max_history_turns:
+            return {"messages": []}
+        keep_from = turn_starts[-(self.max_history_turns + 1)]
+        return {"messages": [RemoveMessage(id = message.id) for message in messages[:keep_from]]}
 
+    def build_graph(self, checkpointer=None):
         workflow = StateGraph(State)
+        workflow.add_node("trim_history", self.trim_history)
         workflow.add_node("get_all_tables", self.get_all_tables)
         workflow.add_node("get_schema_for_all_tables", self.get_schema_for_all_tables)
         workflow.add_node("generate_query", self.generate_query)
@@ -383,26 +608,43 @@ class SQLAgent:
         workflow.add_node("execute_query", self.execute_query)
         workflow.add_node("submit_final_answer", self.submit_final_answer)
 
-        workflow.add_edge(START, "get_all_tables")
+        workflow.add_conditional_edges(START, self.route_turn, ["trim_history", "get_all_tables"])
+        workflow.add_edge("trim_history", "generate_query")
         workflow.add_edge("get_all_tables", "get_schema_for_all_tables")
         workflow.add_edge("get_schema_for_all_tables", "generate_query")
         workflow.add_edge("generate_query", "correct_and_optimize_query")
         workflow.add_edge("correct_and_optimize_query", "execute_query")
         workflow.add_edge("execute_query", "submit_final_answer")
         workflow.add_edge("submit_final_answer", END)
-        app = workflow.compile()
+        return workflow.compile(checkpointer = checkpointer)
+
+    def graph_workflow(self, user_query: str, thread_id: str = None, sample_percent: float = None):
+        """
+        Answer a question. With a thread_id the question joins that conversation,
+        reusing its schema, previous SQL and results. With sample_percent an eligible
+        query runs on a sample of its table and the answer is labelled as approximate.
+        """
+        app = self.warmup()
+        config = None
+        if thread_id:
+            with self._lock:
+                app = self.conversation_app
+            self.conversations.touch(thread_id)
+            config = {"configurable": {"thread_id": thread_id}}
 
-        response = app.invoke({"messages": [HumanMessage(content = user_query)]})
-        print("--------------------------------Final response--------------------------------")
+        response = app.invoke(
+            {"messages": [HumanMessage(content = user_query)], "sample_percent": sample_percent}, config)
         query_result = response["messages"][-1].content
-        query_used = response["messages"][-3].content
+        # The exact SQL, which exports re-run, and the rewrite that ran instead if it was sampled
+        query_used = response["sql"]
+        sampled_query = response.get("sampled_sql")
 
-        return query_result, query_used
+        return query_result, query_used, sampled_query
         
 
 if __name__ == "__main__":
     agent = SQLAgent()
     agent.add_db("sqlite", url = "https://storage.googleapis.com/benchmarks-artifacts/chinook/Chinook.db")
-    query_result, query_used = agent.graph_workflow("Led Zeppelin's vs Queen's total sales and number of tracks sold in every year")
+    query_result, query_used, _ = agent.graph_workflow("Led Zeppelin's vs Queen's total sales and number of tracks sold in every year")
     print(query_result)
     print(query_used)
\ No newline at end of file
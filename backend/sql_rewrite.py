@@ -0,0 +1,118 @@
+"""
+Rewrites of generated SQL that trade exactness for speed.
+
+`sample_query` turns a single-table SELECT into one that reads a sample of the
+table, using the dialect's native sampling where there is one:
+- PostgreSQL and Snowflake: TABLESAMPLE SYSTEM (block sampling, no full scan)
+- SQLite: a rowid-modulo subquery
+
+Only aggregate queries are sampled: the select list must compute COUNT, SUM,
+AVG, MIN or MAX, and window functions are not allowed, since neither row
+listings nor per-row window values can be approximated from a sample. COUNT
+and SUM are scaled up by the inverse sampling rate so totals stay in the right
+order of magnitude; AVG, MIN and MAX are left as they are.
+"""
+import re
+from typing import NamedTuple, Optional
+
+SAMPLING_DIALECTS = ("postgresql", "snowflake", "sqlite")
+
+AGGREGATE = re.compile(r"\b(count|sum|avg|min|max)\s*\(", re.I)
+
+CLAUSE_KEYWORDS = {"where", "group", "order", "limit", "having", "window", "qualify", "offset", "fetch", "union"}
+
+IDENTIFIER = r'(?:"[^"]+"|`[^`]+`|\[[^\]]+\]|\w+)'
+
+FROM_TABLE = re.compile(
+    rf"\bfrom\s+(?P<table>{IDENTIFIER}(?:\s*\.\s*{IDENTIFIER})*)"
+    rf"(?:\s+(?:as\s+)?(?P<alias>{IDENTIFIER}))?",
+    re.I,
+)
+
+
+class SampledQuery(NamedTuple):
+    sql: str
+    table: str
+    percent: float
+
+
+def strip_comments(sql: str) -> str:
+    return re.sub(r"--[^\n]*|/\*.*?\*/", " ", sql, flags = re.S).strip().rstrip(";").strip()
+
+
+def _scale_aggregates(sql: str, factor: str) -> str:
+    """Wrap every COUNT(...) and SUM(...) in a multiplication by factor"""
+    out, position = [], 0
+    for match in re.finditer(r"\b(count|sum)\s*\(", sql, re.I):
+        if match.start() < position:
+            continue
+        depth, end = 0, match.end() - 1
+        for end in range(match.end() - 1, len(sql)):
+            depth += {"(": 1, ")": -1}.get(sql[end], 0)
+            if depth == 0:
+                break
+        out.append(sql[position:match.start()])
+        out.append(f"({sql[match.start():end + 1]} * {factor})")
+        position = end + 1
+    out.append(sql[position:])
+    return "".join(out)
+
+
+def sample_query(sql: str, dialect: str, percent: float) -> Optional[SampledQuery]:
+    """
+    Rewrite a query to run on roughly `percent`% of its table's rows.
+
+    Returns None when the query is not eligible: not a plain SELECT over a single
+    table (joins, subqueries, CTEs and set operations would sample inconsistently),
+    no aggregate in the select list (point lookups and listings would silently
+    miss rows), a window function or COUNT(DISTINCT ...) that cannot be scaled,
+    or an unsupported dialect.
+    """
+    if dialect not in SAMPLING_DIALECTS or not 0 < percent < 100:
+        return None
+    statement = strip_comments(sql)
+    lowered = statement.lower()
+    if not re.match(r"select\b", lowered) or ";" in statement:
+        return None
+    if len(re.findall(r"\bfrom\b", lowered)) != 1 or re.search(r"\(\s*select\b", lowered):
+        return None
+    if re.search(r"\b(join|union|intersect|except)\b", lowered) or re.search(r"\bcount\s*\(\s*distinct\b", lowered):
+        return None
+    if re.search(r"\bover\b", lowered):
+        return None
+
+    match = FROM_TABLE.search(statement)
+    if match is None:
+        return None
+    alias = match.group("alias")
+    if alias and alias.lower() in CLAUSE_KEYWORDS:
+        alias = None
+    end = match.end("alias") if alias else match.end("table")
+    if statement[end:].lstrip().startswith(","):
+        # Implicit join: FROM a, b
+        return None
+    if not AGGREGATE.search(statement[:match.start()]):
+        return None
+    # Drop the whitespace around the dots only; quoted names keep theirs
+    parts = re.findall(IDENTIFIER, match.group("table"))
+    table = ".".join(parts)
+
+    if dialect == "sqlite":
+        # Keep every n-th rowid; rowids are dense for most tables, so this is close to an n-th of the rows
+        modulo = max(2, round(100 / percent))
+        percent = 100 / modulo
+        name = alias or parts[-1]
+        sampled = f"FROM (SELECT * FROM {table} WHERE rowid % {modulo} = 0) AS {name}"
+        factor = str(modulo)
+    else:
+        sampled = statement[match.start():end] + f" TABLESAMPLE SYSTEM ({percent:g})"
+        factor = f"{100 / percent:g}"
+
+    select_list, rest = statement[:match.start()], statement[end:]
+    rewritten = _scale_aggregates(select_list, factor) + sampled + _scale_aggregates(rest, factor)
+    return SampledQuery(rewritten, table, percent)
+
+
+def approximation_note(sample: SampledQuery) -> str:
+    return (f"_Approximate answer: computed on a ~{sample.percent:g}% sample of `{sample.table}`; "
+            f"counts and sums are scaled up to the full table._")
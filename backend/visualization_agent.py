@@ -1,5 +1,3 @@
-from langchain_experimental.utilities import PythonREPL
-from langchain_openai import ChatOpenAI
 from langgraph.graph import END, StateGraph, START
 from typing import Annotated, TypedDict
 from langchain_core.messages import AIMessage, HumanMessage
@@ -7,18 +5,29 @@ from langchain_core.prompts import ChatPromptTemplate, MessagesPlaceholder
 from langgraph.graph.message import AnyMessage, add_messages
 from typing import Sequence
 from pydantic import BaseModel, Field
-import pandas as pd
 import logging
 import io  # Add this import
 import base64  # Add this import
-import matplotlib
-matplotlib.use('Agg')  # Set this before importing pyplot
-import matplotlib.pyplot as plt
-import numpy as np
+import time
+import threading
+from llm_limiter import LLM_LIMITER, lower_llm_priority
+from metrics import timed_node, llm_callback_handler, VIZ_RENDER_DURATION, VIZ_PAYLOAD_BYTES
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+_pyplot = None
+
+def get_pyplot():
+    """Import pyplot on first use, selecting the Agg backend before it loads"""
+    global _pyplot
+    if _pyplot is None:
+        import matplotlib
+        matplotlib.use('Agg')  # Set this before importing pyplot
+        import matplotlib.pyplot as plt
+        _pyplot = plt
+    return _pyplot
+
 class State(TypedDict):
     messages: Annotated[Sequence[AnyMessage], add_messages]
 
@@ -29,16 +38,33 @@ class VisualizationAdvice(BaseModel):
     advice: str = Field(..., description="Should only and only consists of valid advice on how to create the best, intuitive and comprehensive visualization")
 
 class VisualizationAgent:
-    def __init__(self):
-        self.llm = ChatOpenAI(model="gpt-4o-mini", temperature=0)
-        self.python_repl = PythonREPL()
+    def __init__(self, llm=None):
+        # The OpenAI client and the Python REPL are created on first use
+        self._llm = llm
+        self._python_repl = None
+        self.app = None
+        # pyplot keeps global figure state, so only one visualization renders at a time
+        self._render_lock = threading.Lock()
+
+    @property
+    def llm(self):
+        if self._llm is None:
+            from langchain_openai import ChatOpenAI
+            self._llm = ChatOpenAI(model="gpt-4o-mini", temperature=0, max_retries=0, callbacks=[llm_callback_handler()])
+        return self._llm
+
+    @property
+    def python_repl(self):
+        if self._python_repl is None:
+            from langchain_experimental.utilities import PythonREPL
+            self._python_repl = PythonREPL()
+        return self._python_repl
     
+    @timed_node("visualization_agent")
     def create_python_code(self, state: State):
         """Create visualization based on the query result"""
         messages = state["messages"]
-        print("---------------------------Creating python code---------------------------")
-        print(f"Messages inside the create_python_code function: {messages}")
-        print("---------------------------------------------------------------------------")
+        logger.debug("Messages inside the create_python_code function: %s", messages)
         
         create_python_code_system = """
 
@@ -138,17 +164,15 @@ class VisualizationAgent:
         ])
         formatted_create_python_code_prompt = create_python_code_prompt.invoke({"messages": messages})
         create_python_code_llm = self.llm.with_structured_output(VisualizationCode)
-        create_python_code_result = create_python_code_llm.invoke(formatted_create_python_code_prompt)
-        print(create_python_code_result)
-        print("--------------------------------Python code created--------------------------------")
+        create_python_code_result = LLM_LIMITER.invoke(create_python_code_llm, formatted_create_python_code_prompt)
+        logger.debug("Python code created: %s", create_python_code_result.code)
         return {"messages": state["messages"] + [AIMessage(content = f"{create_python_code_result.code}")]}
     
+    @timed_node("visualization_agent")
     def viz_advice(self, state: State):
         """Give advice on how to improve the visualization"""
         messages = state["messages"]
-        print("---------------------------Giving advice on how to improve the visualization---------------------------")
-        print(f"Messages inside the viz_advice function: {messages}")
-        print("---------------------------------------------------------------------------")
+        logger.debug("Messages inside the viz_advice function: %s", messages)
 
         viz_advice_system = """
         **You are a data visualization expert.**
@@ -277,53 +301,24 @@ Use these guidelines to advise on creating the most effective, intuitive, and co
         ])
         formatted_viz_advice_prompt = viz_advice_prompt.invoke({})
         viz_advice_llm = self.llm.with_structured_output(VisualizationAdvice)
-        viz_advice_result = viz_advice_llm.invoke(formatted_viz_advice_prompt)
-        print(viz_advice_result)
-        print("--------------------------------Advice given--------------------------------")
+        viz_advice_result = LLM_LIMITER.invoke(viz_advice_llm, formatted_viz_advice_prompt)
+        logger.debug("Visualization advice: %s", viz_advice_result.advice)
         return {"messages": state["messages"] + [AIMessage(content = f"{viz_advice_result.advice}")]}
     
 
+    @timed_node("visualization_agent")
     def create_visualization(self, state: State):
         messages = state["messages"]
         python_code = messages[-1].content
+        plt = get_pyplot()
 
+        with self._render_lock:
+            return self._render(state, python_code, plt)
+
+    def _render(self, state: State, python_code: str, plt):
+        start = time.perf_counter()
         try:
-            plt.style.use('seaborn-v0_8-whitegrid')
-            plt.rcParams.update({
-                # Increase figure size
-                'figure.figsize': (20, 12),
-                'figure.dpi': 300,
-                
-                # Keep font sizes smaller for better aesthetics
-                'axes.titlesize': 14,
-                'axes.labelsize': 12,
-                'xtick.labelsize': 10,
-                'ytick.labelsize': 10,
-                'legend.fontsize': 10,
-                
-                # Other settings remain the same
-                'font.family': 'sans-serif',
-                'font.sans-serif': ['Arial', 'Helvetica'],
-                'font.weight': 'medium',
-                'figure.facecolor': '#ffffff',
-                'axes.facecolor': '#ffffff',
-                'axes.edgecolor': '#E2E8F0',
-                'axes.linewidth': 0.8,
-                'axes.grid': True,
-                'axes.titleweight': 'semibold',
-                'axes.titlepad': 20,
-                'axes.labelweight': 'medium',
-                'axes.labelcolor': '#4B5563',
-                'axes.spines.top': False,
-                'axes.spines.right': False,
-                'grid.color': '#E2E8F0',
-                'grid.alpha': 0.2,
-                'grid.linestyle': '--',
-                'legend.frameon': False,
-                'figure.constrained_layout.use': True,
-                'figure.constrained_layout.h_pad': 1.0,
-                'figure.constrained_layout.w_pad': 1.0
-            })
+            self.apply_plot_style()
                 
             # Execute visualization code
             output = self.python_repl.run(python_code)
@@ -345,6 +340,8 @@ Use these guidelines to advise on creating the most effective, intuitive, and co
             
             img_str = base64.b64encode(buf.getvalue()).decode('utf-8')
             img_data_url = f"data:image/png;base64,{img_str}"
+            VIZ_RENDER_DURATION.observe(time.perf_counter() - start)
+            VIZ_PAYLOAD_BYTES.observe(len(img_data_url))
             
             plt.close('all')
             
@@ -354,7 +351,59 @@ Use these guidelines to advise on creating the most effective, intuitive, and co
             logger.error(f"Error creating visualization: {str(e)}")
             return {"messages": state["messages"] + [AIMessage(content=f"Error creating visualization: {str(e)}")]}
 
-    def graph_workflow(self, query_result: str):
+    def apply_plot_style(self):
+        """Apply the base matplotlib style used for every visualization"""
+        plt = get_pyplot()
+        plt.style.use('seaborn-v0_8-whitegrid')
+        plt.rcParams.update({
+            # Increase figure size
+            'figure.figsize': (20, 12),
+            'figure.dpi': 300,
+            
+            # Keep font sizes smaller for better aesthetics
+            'axes.titlesize': 14,
+            'axes.labelsize': 12,
+            'xtick.labelsize': 10,
+            'ytick.labelsize': 10,
+            'legend.fontsize': 10,
+            
+            # Other settings remain the same
+            'font.family': 'sans-serif',
+            'font.sans-serif': ['Arial', 'Helvetica'],
+            'font.weight': 'medium',
+            'figure.facecolor': '#ffffff',
+            'axes.facecolor': '#ffffff',
+            'axes.edgecolor': '#E2E8F0',
+            'axes.linewidth': 0.8,
+            'axes.grid': True,
+            'axes.titleweight': 'semibold',
+            'axes.titlepad': 20,
+            'axes.labelweight': 'medium',
+            'axes.labelcolor': '#4B5563',
+            'axes.spines.top': False,
+            'axes.spines.right': False,
+            'grid.color': '#E2E8F0',
+            'grid.alpha': 0.2,
+            'grid.linestyle': '--',
+            'legend.frameon': False,
+            'figure.constrained_layout.use': True,
+            'figure.constrained_layout.h_pad': 1.0,
+            'figure.constrained_layout.w_pad': 1.0
+        })
+
+    def warmup(self):
+        """Render a throwaway figure so the Agg backend, style sheet and font cache are loaded before the first request"""
+        plt = get_pyplot()
+        with self._render_lock:
+            self.apply_plot_style()
+            plt.figure(figsize=(4, 3))
+            plt.plot([0, 1], [0, 1])
+            plt.savefig(io.BytesIO(), format='png', dpi=50)
+            plt.close('all')
+        if self.app is None:
+            self.app = self.build_graph()
+
+    def build_graph(self):
         workflow = StateGraph(State)
         
         workflow.add_node("create_python_code", self.create_python_code)
@@ -367,14 +416,21 @@ Use these guidelines to advise on creating the most effective, intuitive, and co
         #workflow.add_edge("correct_python_code", "create_visualization")
         workflow.add_edge("create_visualization", END)
         
-        app = workflow.compile()
-        
+        return workflow.compile()
+
+    def graph_workflow(self, query_result: str):
+        if self.app is None:
+            self.app = self.build_graph()
 
-        response = app.invoke({"messages": [HumanMessage(content=query_result)]})
+        # Charts are secondary to answering questions, so they queue behind interactive LLM calls
+        with lower_llm_priority("visualization"):
+            response = self.app.invoke({"messages": [HumanMessage(content=query_result)]})
         return response["messages"][-1].content
     
     def apply_style_enhancements(self):
         """Apply consistent style enhancements to the current plot"""
+        import numpy as np
+        plt = get_pyplot()
         # Get current axis
         ax = plt.gca()
         
@@ -406,6 +462,7 @@ Use these guidelines to advise on creating the most effective, intuitive, and co
 
     def get_color_palette(self, n_colors):
         """Generate a consistent color palette for n series"""
+        plt = get_pyplot()
         if n_colors == 1:
             return ['#6366F1']
         elif n_colors == 2: